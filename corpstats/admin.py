@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from .models import CorpStat, CorpMember
+from .models import CorpStat, CorpMember, TrackedCharacter
 
 admin.site.register(CorpStat)
-admin.site.register(CorpMember)
\ No newline at end of file
+admin.site.register(CorpMember)
+admin.site.register(TrackedCharacter)
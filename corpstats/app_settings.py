@@ -0,0 +1,37 @@
+from django.conf import settings
+
+# number of members resolved and written per batch during an update, bounds the instances built at a time
+CORPSTATS_UPDATE_BATCH_SIZE = getattr(settings, 'CORPSTATS_UPDATE_BATCH_SIZE', 500)
+
+# track and log the peak python memory used by each update, this slows updates down
+CORPSTATS_TRACE_MEMORY = getattr(settings, 'CORPSTATS_TRACE_MEMORY', False)
+
+# seconds the bulk token owner affiliation lookups are trusted for before updates look them up again
+CORPSTATS_AFFILIATION_CACHE_TIME = getattr(settings, 'CORPSTATS_AFFILIATION_CACHE_TIME', 900)
+
+# render only a summary row per main on the corp page and load each mains alts when it is expanded
+CORPSTATS_LAZY_MAINS = getattr(settings, 'CORPSTATS_LAZY_MAINS', False)
+
+# portrait urls each process memoises, a roster renders every members portrait on several tabs
+CORPSTATS_PORTRAIT_CACHE_SIZE = getattr(settings, 'CORPSTATS_PORTRAIT_CACHE_SIZE', 100000)
+
+# seconds the alts of an expanded main are cached for
+CORPSTATS_ALTS_CACHE_TIME = getattr(settings, 'CORPSTATS_ALTS_CACHE_TIME', 300)
+
+# entries kept by each of the in-process caches in front of the shared cache, 0 turns them off
+CORPSTATS_LOCAL_CACHE_SIZE = getattr(settings, 'CORPSTATS_LOCAL_CACHE_SIZE', 256)
+
+# seconds entries live in the in-process caches, changes that drop them early are listed in the README
+CORPSTATS_LOCAL_CACHE_TIME = getattr(settings, 'CORPSTATS_LOCAL_CACHE_TIME', 60)
+
+# celery priority of manual updates, lower runs first so they jump ahead of the scheduled updates
+CORPSTATS_REFRESH_PRIORITY = getattr(settings, 'CORPSTATS_REFRESH_PRIORITY', 1)
+
+# seconds a queued manual update blocks more manual updates of the same corp, in case its worker dies
+CORPSTATS_REFRESH_LOCK_TIME = getattr(settings, 'CORPSTATS_REFRESH_LOCK_TIME', 600)
+
+# celery tasks the scheduled updates count the linked characters of a corp in, 1 counts them in the update task
+CORPSTATS_STATS_WORKERS = getattr(settings, 'CORPSTATS_STATS_WORKERS', 1)
+
+# days a CorpStat can go without updating before its members are dropped by the retention task, 0 keeps them
+CORPSTATS_RETENTION_DAYS = getattr(settings, 'CORPSTATS_RETENTION_DAYS', 90)
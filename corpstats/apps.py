@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class CorpStatsConfig(AppConfig):
     name = 'corpstats'
     label = 'corpstats'
+
+    def ready(self):
+        from . import signals
+        signals.connect_service_signals()
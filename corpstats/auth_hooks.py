@@ -2,6 +2,7 @@ from allianceauth.services.hooks import MenuItemHook, UrlHook
 from django.utils.translation import gettext_lazy as _
 from allianceauth import hooks
 from . import urls
+from .permissions import get_permission_scope
 
 
 class CorpStats(MenuItemHook):
@@ -13,9 +14,7 @@ class CorpStats(MenuItemHook):
                               navactive=['corpstat:'])
 
     def render(self, request):
-        if request.user.has_perm('corpstats.view_corp_corpstats') or request.user.has_perm(
-                'corpstats.view_alliance_corpstats') or request.user.has_perm(
-                'corpstats.add_corpstat') or request.user.has_perm('corpstats.view_state_corpstats'):
+        if get_permission_scope(request.user).in_menu:
             return MenuItemHook.render(self, request)
         return ''
 
@@ -0,0 +1,73 @@
+import threading
+import time
+from collections import OrderedDict
+
+from . import app_settings
+
+
+class LocalCache:
+    """
+    Small in-process LRU with a TTL that sits in front of the shared cache.
+    Every entry carries a version, once the version a caller asks for has moved on the entry is a miss.
+    """
+
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version or entry[1] < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key, value, version=None):
+        if self.max_size < 1:
+            return
+        with self._lock:
+            self._entries[key] = (version, time.monotonic() + self.timeout, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0}
+
+
+# corp overviews by CorpStat pk, versioned on CorpStat.last_update and the stats revision
+overviews = LocalCache(app_settings.CORPSTATS_LOCAL_CACHE_SIZE, app_settings.CORPSTATS_LOCAL_CACHE_TIME)
+# pks of the CorpStats visible to a user by user pk, versioned on `models.get_visibility_version`
+visibility = LocalCache(app_settings.CORPSTATS_LOCAL_CACHE_SIZE, app_settings.CORPSTATS_LOCAL_CACHE_TIME)
+
+
+def get_hit_rates():
+    """
+    Hit rate counters of the local caches in this process
+    """
+    return {'overviews': overviews.stats(), 'visibility': visibility.stats()}
+
+
+def clear():
+    overviews.clear()
+    visibility.clear()
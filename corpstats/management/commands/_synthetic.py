@@ -0,0 +1,148 @@
+"""
+Synthetic corps for the benchmark and load test commands
+"""
+from django.contrib.auth.models import User
+from django.core.exceptions import FieldDoesNotExist
+from django.db import DatabaseError, models, transaction
+from django.db.models import Min
+from esi.models import Token
+
+from allianceauth.authentication.models import CharacterOwnership, State, UserProfile, get_guest_state
+from allianceauth.eveonline.models import EveAllianceInfo, EveCharacter, EveCorporationInfo
+
+from ...models import CorpStat, CorpMember, SERVICE_DB
+
+# ids from ranges CCP uses for asteroids and planetary districts, never for characters, corps or alliances,
+# so the synthetic rows can't collide with real ones and removing them can't touch real data
+CHARACTER_ID_BASE = 70000000
+CHARACTER_ID_SPAN = 10000000
+CORP_ID_BASE = 82000000
+ALLIANCE_ID_BASE = 83000000
+ID_SPAN = 10000
+USERNAME_PREFIX = 'corpstats-synthetic-'
+STATE_PREFIX = 'Synthetic State '
+
+
+def build_alliance(index=0):
+    return EveAllianceInfo.objects.create(alliance_id=ALLIANCE_ID_BASE + index, alliance_name=f'Synthetic Alliance {index}',
+                                          alliance_ticker=f'SYNA{index}', executor_corp_id=CORP_ID_BASE)
+
+
+def build_states(count):
+    """
+    `count` states below every existing one, so real users never end up in them
+    """
+    lowest = State.objects.aggregate(lowest=Min('priority'))['lowest'] or 0
+    return [State.objects.create(name=f'{STATE_PREFIX}{i}', priority=lowest - 1 - i) for i in range(count)]
+
+
+def get_service_models():
+    """
+    Account models of the installed services we count, by service name
+    """
+    service_models = {}
+    for service, relation in SERVICE_DB.items():
+        try:
+            service_models[service] = User._meta.get_field(relation).related_model
+        except FieldDoesNotExist:
+            continue  # service not installed
+    return service_models
+
+
+def _service_account(model, user_id):
+    # fill the required fields of the account model with values derived from the user, whatever the service
+    values = {'user_id': user_id}
+    for field in model._meta.concrete_fields:
+        if field.primary_key or field.null or field.has_default() or field.attname in values:
+            continue
+        if isinstance(field, (models.IntegerField, models.DecimalField, models.FloatField)):
+            values[field.attname] = user_id
+        elif isinstance(field, models.CharField):
+            values[field.attname] = f'{USERNAME_PREFIX}{user_id}'[:field.max_length]
+        elif isinstance(field, models.TextField):
+            values[field.attname] = f'{USERNAME_PREFIX}{user_id}'
+    return model(**values)
+
+
+def build_service_accounts(user_ids, share):
+    """
+    Accounts on every installed service for `share` of the users. Services whose accounts can't be made up are skipped.
+    """
+    user_ids = user_ids[:int(len(user_ids) * share)]
+    for model in get_service_models().values():
+        try:
+            with transaction.atomic():
+                model.objects.bulk_create([_service_account(model, user_id) for user_id in user_ids], batch_size=1000)
+        except (DatabaseError, TypeError, ValueError):
+            continue
+
+
+def build_corp(index, characters, characters_per_user=4, registered=0.8, alliance=None, state=None, services=0.0):
+    """
+    A tracked corp of `characters` members, `registered` of them owned by users with `characters_per_user` characters,
+    the first character of each user being their main. `services` of the users get an account on each service.
+    Written with bulk_create, so none of the auth signals fire.
+    """
+    corp_id = CORP_ID_BASE + index
+    first_id = CHARACTER_ID_BASE + index * characters
+    if index >= ID_SPAN or first_id + characters > CHARACTER_ID_BASE + CHARACTER_ID_SPAN:
+        raise ValueError(f'Synthetic corp {index} of {characters} characters is outside the synthetic id ranges')
+    corp = EveCorporationInfo.objects.create(corporation_id=corp_id, corporation_name=f'Synthetic Corp {index}',
+                                             corporation_ticker=f'SYN{index}', member_count=characters,
+                                             alliance=alliance)
+    Token.objects.bulk_create([Token(character_id=first_id, character_name=f'Synthetic {first_id}',
+                                     character_owner_hash=f'{USERNAME_PREFIX}{first_id}', access_token='synthetic')])
+    cs = CorpStat.objects.create(corp=corp, token=Token.objects.get(character_owner_hash=f'{USERNAME_PREFIX}{first_id}'))
+
+    EveCharacter.objects.bulk_create([
+        EveCharacter(character_id=c_id, character_name=f'Synthetic {c_id}', corporation_id=corp_id,
+                     corporation_name=corp.corporation_name, corporation_ticker=corp.corporation_ticker,
+                     alliance_id=alliance.alliance_id if alliance else None,
+                     alliance_name=alliance.alliance_name if alliance else None,
+                     alliance_ticker=alliance.alliance_ticker if alliance else None)
+        for c_id in range(first_id, first_id + characters)], batch_size=1000)
+    chars = dict(EveCharacter.objects.filter(corporation_id=corp_id).values_list('character_id', 'pk'))
+
+    user_count = int(characters * registered) // characters_per_user
+    User.objects.bulk_create([User(username=f'{USERNAME_PREFIX}{index}-{u}') for u in range(user_count)],
+                             batch_size=1000)
+    users = dict(User.objects.filter(username__startswith=f'{USERNAME_PREFIX}{index}-').values_list('username', 'pk'))
+    if state is None:
+        state = get_guest_state()
+    else:
+        State.member_corporations.through.objects.create(state=state, evecorporationinfo=corp)
+    UserProfile.objects.bulk_create([
+        UserProfile(user_id=users[f'{USERNAME_PREFIX}{index}-{u}'], state=state,
+                    main_character_id=chars[first_id + u * characters_per_user])
+        for u in range(user_count)], batch_size=1000)
+    CharacterOwnership.objects.bulk_create([
+        CharacterOwnership(user_id=users[f'{USERNAME_PREFIX}{index}-{u}'], character_id=chars[c_id],
+                           owner_hash=f'{USERNAME_PREFIX}{c_id}')
+        for u in range(user_count)
+        for c_id in range(first_id + u * characters_per_user, first_id + (u + 1) * characters_per_user)],
+        batch_size=1000)
+    if services:
+        build_service_accounts(sorted(users.values()), services)
+
+    CorpMember.objects.bulk_create([
+        CorpMember(corpstats=cs, character_id=c_id, character_name=f'Synthetic {c_id}')
+        for c_id in range(first_id, first_id + characters)], batch_size=1000)
+    return cs
+
+
+def remove_corps():
+    """
+    Remove everything `build_corp` created
+    """
+    User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+    Token.objects.filter(character_owner_hash__startswith=USERNAME_PREFIX).delete()
+    # only characters that are both in the synthetic id range and in a synthetic corp
+    EveCharacter.objects.filter(character_id__range=(CHARACTER_ID_BASE, CHARACTER_ID_BASE + CHARACTER_ID_SPAN - 1),
+                                corporation_id__range=(CORP_ID_BASE, CORP_ID_BASE + ID_SPAN - 1)).delete()
+    EveCorporationInfo.objects.filter(corporation_id__range=(CORP_ID_BASE, CORP_ID_BASE + ID_SPAN - 1)).delete()
+    EveAllianceInfo.objects.filter(alliance_id__range=(ALLIANCE_ID_BASE, ALLIANCE_ID_BASE + ID_SPAN - 1)).delete()
+    State.objects.filter(name__startswith=STATE_PREFIX).delete()
+
+
+def corps_exist():
+    return EveCorporationInfo.objects.filter(corporation_id__range=(CORP_ID_BASE, CORP_ID_BASE + ID_SPAN - 1)).exists()
@@ -0,0 +1,126 @@
+import random
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from esi.models import Token
+
+from allianceauth.eveonline.models import EveCorporationInfo
+
+from ...models import CorpStat, CorpMember
+from ._synthetic import CHARACTER_ID_BASE, CHARACTER_ID_SPAN, CORP_ID_BASE, ID_SPAN
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the corpstats member queries with and without the CorpMember indexes on synthetic data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=50000, help='Members per synthetic corp')
+        parser.add_argument('--corps', type=int, default=5, help='Synthetic corps, the first one is measured')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per query, the best is reported')
+        parser.add_argument('--force', action='store_true',
+                            help='Run without DEBUG on, this drops the CorpMember indexes of the database while it runs')
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['force']:
+            raise CommandError('This drops and re-adds the CorpMember indexes of {}, only run it against a development '
+                               'database with DEBUG on, or pass --force.'.format(connection.settings_dict['NAME']))
+        if options['corps'] > ID_SPAN or options['corps'] * options['members'] > CHARACTER_ID_SPAN:
+            raise CommandError('At most {} corps and {} members in total fit the synthetic id ranges.'.format(
+                ID_SPAN, CHARACTER_ID_SPAN))
+        if EveCorporationInfo.objects.filter(corporation_id__gte=CORP_ID_BASE,
+                                             corporation_id__lt=CORP_ID_BASE + options['corps']).exists():
+            raise CommandError('Synthetic corps already exist, remove them before benchmarking.')
+
+        self.stdout.write('Building {} corps of {} members...'.format(options['corps'], options['members']))
+        corpstats = self.build(options['corps'], options['members'])
+        try:
+            self.analyze()
+            with_indexes = self.measure(corpstats[0], options['members'], options['repeat'])
+            self.drop_indexes()
+            try:
+                self.analyze()
+                without_indexes = self.measure(corpstats[0], options['members'], options['repeat'])
+            finally:
+                self.add_indexes()
+        finally:
+            EveCorporationInfo.objects.filter(pk__in=[cs.corp_id for cs in corpstats]).delete()
+            Token.objects.filter(pk__in=[cs.token_id for cs in corpstats]).delete()
+
+        self.stdout.write('')
+        self.stdout.write('{:<16}{:>14}{:>14}'.format('query', 'no index (ms)', 'indexed (ms)'))
+        for name, (ms, plan) in with_indexes.items():
+            self.stdout.write('{:<16}{:>14.2f}{:>14.2f}'.format(name, without_indexes[name][0], ms))
+        for label, results in (('without indexes', without_indexes), ('with indexes', with_indexes)):
+            self.stdout.write('')
+            self.stdout.write(self.style.MIGRATE_HEADING('Plans {}:'.format(label)))
+            for name, (ms, plan) in results.items():
+                self.stdout.write('{}:\n{}'.format(name, plan))
+
+    def build(self, corp_count, member_count):
+        now = timezone.now()
+        corpstats = []
+        for c in range(corp_count):
+            corp = EveCorporationInfo.objects.create(corporation_id=CORP_ID_BASE + c,
+                                                     corporation_name='Benchmark Corp {}'.format(c),
+                                                     corporation_ticker='BNCH{}'.format(c),
+                                                     member_count=member_count)
+            # bulk_create skips the ownership signals, which would ask ESI about the character
+            Token.objects.bulk_create([Token(character_id=CHARACTER_ID_BASE + c * member_count,
+                                                     character_name='Benchmark Director {}'.format(c),
+                                                     character_owner_hash='corpstats-benchmark-{}'.format(c),
+                                                     access_token='benchmark')])
+            cs = CorpStat.objects.create(corp=corp, token=Token.objects.get(
+                character_owner_hash='corpstats-benchmark-{}'.format(c)))
+            CorpMember.objects.bulk_create([
+                CorpMember(corpstats=cs,
+                           character_id=CHARACTER_ID_BASE + c * member_count + m,
+                           character_name='Member {:08x}'.format(random.getrandbits(32)),
+                           logon_date=now - timedelta(minutes=random.randint(0, 525600)),
+                           logoff_date=now)
+                for m in range(member_count)], batch_size=1000)
+            corpstats.append(cs)
+        return corpstats
+
+    def queries(self, cs, member_count):
+        # the member queries get_stats, the views and update_tracked_characters issue for one corp
+        members = CorpMember.objects.filter(corpstats=cs)
+        linked = random.sample(range(CHARACTER_ID_BASE, CHARACTER_ID_BASE + member_count), member_count // 10)
+        return {
+            'roster': members.values_list('character_id', 'character_name'),
+            'tracking': members.filter(character_id__in=linked).values_list('character_id', 'character_name'),
+            'unregistered': members.exclude(character_id__in=linked).values_list('character_id', 'character_name'),
+        }
+
+    def measure(self, cs, member_count, repeat):
+        results = {}
+        for name, qs in self.queries(cs, member_count).items():
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                list(qs.all())
+                elapsed = (time.perf_counter() - start) * 1000
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = (best, qs.explain())
+        return results
+
+    def analyze(self):
+        table = connection.ops.quote_name(CorpMember._meta.db_table)
+        with connection.cursor() as cursor:
+            if connection.vendor == 'mysql':
+                cursor.execute('ANALYZE TABLE {}'.format(table))
+            elif connection.vendor in ('postgresql', 'sqlite'):
+                cursor.execute('ANALYZE {}'.format(table))
+
+    def drop_indexes(self):
+        with connection.schema_editor() as editor:
+            for index in CorpMember._meta.indexes:
+                editor.remove_index(CorpMember, index)
+
+    def add_indexes(self):
+        with connection.schema_editor() as editor:
+            for index in CorpMember._meta.indexes:
+                editor.add_index(CorpMember, index)
@@ -0,0 +1,117 @@
+import http.client
+import statistics
+import threading
+import time
+from importlib import import_module
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import Permission, User
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from ._synthetic import CORP_ID_BASE, USERNAME_PREFIX, corps_exist
+
+VIEWS = {
+    'view': lambda corp_id: reverse('corpstat:view_corp', args=[corp_id]),
+    'overview': lambda corp_id: reverse('corpstat:view_all'),
+    'search': lambda corp_id: reverse('corpstat:search') + '?search_string=Synthetic+1',
+    'export': lambda corp_id: reverse('corpstat:export', args=[corp_id]),
+}
+
+
+class Command(BaseCommand):
+    help = 'Load tests the corpstats views of a running server on the synthetic corps of corpstats_synthetic over HTTP'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000',
+                            help='Root of the running auth, which has to share this database and session store')
+        parser.add_argument('--concurrency', type=int, default=4, help='Threads sending requests at the same time')
+        parser.add_argument('--requests', type=int, default=100, help='Requests per view, split across the threads')
+        parser.add_argument('--views', nargs='+', choices=list(VIEWS), default=list(VIEWS), help='Views to load test')
+
+    def handle(self, *args, **options):
+        if not corps_exist():
+            raise CommandError('No synthetic corps, build them with corpstats_synthetic first.')
+        # the main of the first synthetic user, who can see every corp for the test
+        user = User.objects.filter(username=f'{USERNAME_PREFIX}0-0').first()
+        if user is None:
+            raise CommandError('The synthetic corps have no registered users to log in as.')
+        user.user_permissions.add(Permission.objects.get(codename='view_all_corpstats',
+                                                         content_type__app_label='corpstats'))
+        url = urlsplit(options['url'])
+        if url.scheme not in ('http', 'https') or not url.netloc:
+            raise CommandError('--url has to be an http or https url like http://127.0.0.1:8000')
+
+        session = self.login(user)
+        try:
+            self.stdout.write('{:<10}{:>10}{:>8}{:>10}{:>10}{:>10}{:>10}'.format(
+                'view', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'))
+            for view in options['views']:
+                path = url.path.rstrip('/') + VIEWS[view](CORP_ID_BASE)
+                latencies, errors, elapsed = self.run(url, path, session.session_key, options['concurrency'],
+                                                      options['requests'])
+                if not latencies:
+                    raise CommandError('Every request to {} failed, is the server running at {}?'.format(
+                        path, options['url']))
+                cuts = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+                self.stdout.write('{:<10}{:>10}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+                    view, len(latencies), errors, cuts[49], cuts[94], cuts[98], len(latencies) / elapsed))
+        finally:
+            session.delete()
+
+    def login(self, user):
+        """
+        A session of `user` in the session store the server reads, the way the test client logs in
+        """
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.save()
+        return session
+
+    def run(self, url, path, session_key, concurrency, requests):
+        """
+        Send `requests` GETs of `path` to the server at `url` from `concurrency` threads, each over its own connection
+
+        :return: latencies in ms of the answered requests, count of failed or non 200 requests, seconds it took
+        """
+        connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        headers = {'Cookie': '{}={}'.format(settings.SESSION_COOKIE_NAME, session_key)}
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+
+        def worker(count):
+            conn = connection_class(url.netloc, timeout=60)
+            try:
+                for _ in range(count):
+                    start = time.perf_counter()
+                    try:
+                        conn.request('GET', path, headers=headers)
+                        response = conn.getresponse()
+                        response.read()
+                    except (OSError, http.client.HTTPException) as e:
+                        conn.close()  # reconnects on the next request
+                        with lock:
+                            errors.append(e)
+                        continue
+                    latency = (time.perf_counter() - start) * 1000
+                    with lock:
+                        latencies.append(latency)
+                        # redirects aren't followed, a redirect to the login page is an error
+                        if response.status != 200:
+                            errors.append(response.status)
+            finally:
+                conn.close()
+
+        threads = [threading.Thread(target=worker, args=(requests // concurrency + (i < requests % concurrency),))
+                   for i in range(concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return latencies, len(errors), time.perf_counter() - start
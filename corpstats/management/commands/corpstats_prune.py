@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from ... import app_settings
+from ...retention import run_retention
+
+
+class Command(BaseCommand):
+    help = 'Prunes orphaned corpstats cache keys and the members of corps that stopped updating'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=app_settings.CORPSTATS_RETENTION_DAYS,
+                            help='Days without an update before a corps members are dropped, 0 keeps them')
+        parser.add_argument('--compact', action='store_true',
+                            help='Compact the tables afterwards, locks them on MySQL while it runs')
+
+    def handle(self, *args, **options):
+        report = run_retention(options['days'], options['compact'])
+        if report['cache_keys'] is None:
+            self.stdout.write("Cache keys: not pruned, the cache backend can't list its keys")
+        else:
+            self.stdout.write('Cache keys: {}'.format(report['cache_keys']))
+        for model, rows in report['rows'].items():
+            self.stdout.write('{} rows: {}'.format(model, rows))
+        if report['bytes'] is None:
+            self.stdout.write("Bytes: unknown, the database can't report its table sizes")
+        else:
+            self.stdout.write('Bytes: {}'.format(report['bytes']))
@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import get_service_registry, merge_counts
+from ._synthetic import CHARACTER_ID_SPAN, build_corp, corps_exist, remove_corps
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks counting the stats of a synthetic corp with different numbers of worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--characters', type=int, default=50000, help='Characters in the synthetic corp')
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='Worker counts to compare')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per worker count, the best is reported')
+
+    def handle(self, *args, **options):
+        if corps_exist():
+            raise CommandError('Synthetic corps already exist, remove them before benchmarking.')
+        if options['characters'] > CHARACTER_ID_SPAN:
+            raise CommandError('At most {} characters fit the synthetic id range.'.format(CHARACTER_ID_SPAN))
+
+        self.stdout.write('Building a corp of {} characters...'.format(options['characters']))
+        try:
+            cs = build_corp(0, options['characters'])
+            self.stdout.write('{:>8}{:>12}{:>10}{:>8}'.format('workers', 'seconds', 'speedup', 'mains'))
+            serial = None
+            for count in options['workers']:
+                best = None
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    mains = self.count(cs, count)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                serial = serial or best
+                self.stdout.write('{:>8}{:>12.2f}{:>10.2f}{:>8}'.format(count, best, serial / best, mains))
+        finally:
+            remove_corps()
+
+    def count(self, cs, workers):
+        """
+        Count the linked characters the way get_stats does with `workers` processes, returns the number of mains
+        """
+        registry = get_service_registry()
+        if workers == 1:
+            return len(cs.count_linked_characters(cs.get_linked_characters(registry), registry)[1])
+        partials = cs.count_in_shards(workers)
+        if partials is None:
+            raise CommandError('Could not count in parallel here, see the log.')
+        return len(merge_counts(partials, registry.services)[1])
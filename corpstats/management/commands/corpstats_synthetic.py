@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ._synthetic import CHARACTER_ID_SPAN, ID_SPAN, build_alliance, build_corp, build_states, corps_exist, remove_corps
+
+
+class Command(BaseCommand):
+    help = 'Fills the database with synthetic corps, mains, alts, states and service accounts for local testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corps', type=int, default=10, help='Synthetic corps, all tracked')
+        parser.add_argument('--characters', type=int, default=5000, help='Characters per corp')
+        parser.add_argument('--characters-per-user', type=int, default=4, help='Characters per user, one main and alts')
+        parser.add_argument('--registered', type=float, default=0.8, help='Share of the characters owned by users')
+        parser.add_argument('--states', type=int, default=2, help='States the corps are spread across')
+        parser.add_argument('--services', type=float, default=0.5,
+                            help='Share of the users with an account on each installed service')
+        parser.add_argument('--remove', action='store_true', help='Remove the synthetic data instead')
+
+    def handle(self, *args, **options):
+        if options['remove']:
+            remove_corps()
+            self.stdout.write('Removed the synthetic corps.')
+            return
+        if corps_exist():
+            raise CommandError('Synthetic corps already exist, remove them with --remove first.')
+        if options['corps'] > ID_SPAN or options['corps'] * options['characters'] > CHARACTER_ID_SPAN:
+            raise CommandError('At most {} corps and {} characters in total fit the synthetic id ranges.'.format(
+                ID_SPAN, CHARACTER_ID_SPAN))
+
+        with transaction.atomic():
+            alliance = build_alliance()
+            states = build_states(options['states'])
+            for index in range(options['corps']):
+                cs = build_corp(index, options['characters'], options['characters_per_user'], options['registered'],
+                                alliance=alliance, state=states[index % len(states)] if states else None,
+                                services=options['services'])
+                self.stdout.write('Built {}'.format(cs))
+        self.stdout.write('Built {} corps of {} characters, remove them with --remove.'.format(
+            options['corps'], options['characters']))
@@ -1,4 +1,9 @@
 from django.db import models
+from django.core.cache import cache
+from allianceauth.eveonline.models import EveCharacter
+from . import local_cache
+from .permissions import get_permission_scope
+import json
 import logging
 
 logger = logging.getLogger(__name__)
@@ -6,8 +11,9 @@ logger = logging.getLogger(__name__)
 
 class CorpStatQuerySet(models.QuerySet):
     def visible_to(self, user):
+        scope = get_permission_scope(user)
 
-        if user.has_perm('corpstats.view_all_corpstats'):  # superusers and users with this permission
+        if scope.view_all:  # superusers and users with this permission
             logger.debug('Returning all corpstats for %s.' % user)
             return self
 
@@ -17,11 +23,11 @@ class CorpStatQuerySet(models.QuerySet):
             # build all accepted queries
             queries = [models.Q(token__user=user)]
 
-            if user.has_perm('corpstats.view_corp_corpstats'):
+            if scope.view_corp:
                 queries.append(models.Q(corp__corporation_id=char.corporation_id))
-            if user.has_perm('corpstats.view_alliance_corpstats'):
+            if scope.view_alliance:
                 queries.append(models.Q(corp__alliance_id=char.alliance_id))
-            if user.has_perm('corpstats.view_state_corpstats'):
+            if scope.view_state:
                 queries.append(models.Q(corp__in=user.profile.state.member_corporations.all()))
                 queries.append(models.Q(
                     corp__alliance_id__in=user.profile.state.member_alliances.all().values_list('alliance_id',
@@ -36,6 +42,70 @@ class CorpStatQuerySet(models.QuerySet):
             logger.debug('User %s has no main character. No corpstats visible.' % user)
             return self.none()
 
+    def get_cached_overviews(self):
+        """
+        Cached overview of every CorpStat in this queryset, from the local cache or a single shared cache round trip.
+        Anything missing from the cache is rebuilt and cached.
+        """
+        from .models import get_stats_revision
+        corpstats = list(self)
+        # the overviews also change between updates, in whichever worker applies a users changes
+        revision = get_stats_revision()
+        local = {cs.pk: local_cache.overviews.get(cs.pk, (cs.last_update, revision)) for cs in corpstats}
+        cached = cache.get_many([cs.build_cache_key() for cs in corpstats if local[cs.pk] is None])
+        stats = []
+        for cs in corpstats:
+            data = cached.get(cs.build_cache_key())
+            if local[cs.pk] is not None:
+                stats.append(local[cs.pk])
+            elif data:
+                overview = json.loads(data)
+                local_cache.overviews.set(cs.pk, overview, (cs.last_update, revision))
+                stats.append(overview)
+            else:
+                stats.append(cs.get_and_cache_stats(only_context=True))
+        return stats
+
+
+class CorpMemberQuerySet(models.QuerySet):
+    def _registered(self):
+        # a registered character is owned by a user with a main, and either it or that main is in the members corp
+        corporation_id = models.OuterRef('corpstats__corp__corporation_id')
+        return models.Exists(EveCharacter.objects.filter(
+            models.Q(corporation_id=corporation_id) |
+            models.Q(character_ownership__user__profile__main_character__corporation_id=corporation_id),
+            character_id=models.OuterRef('character_id'),
+            character_ownership__user__profile__main_character__isnull=False))
+
+    def registered(self):
+        """
+        Members that are registered on auth
+        """
+        return self.filter(self._registered())
+
+    def unregistered(self):
+        """
+        Members that are not registered on auth
+        """
+        return self.filter(~self._registered())
+
+
+class TrackedCharacterQuerySet(models.QuerySet):
+    def main_outside_alliance(self, alliance_id):
+        """
+        Registered characters tracked in the alliance whose main is not in it, characters of users without a main
+        aren't counted. A main in no alliance is outside it.
+        """
+        return self.filter(alliance_id=alliance_id, user__isnull=False, main_character_id__isnull=False) \
+            .exclude(main_alliance_id=alliance_id)
+
+    def users_in_corps(self, count):
+        """
+        Users with characters tracked in at least `count` corps, as dicts of user and corps
+        """
+        return self.filter(user__isnull=False).values('user') \
+            .annotate(corps=models.Count('corporation_id', distinct=True)).filter(corps__gte=count).order_by('user')
+
 
 class CorpStatManager(models.Manager):
     def get_queryset(self):
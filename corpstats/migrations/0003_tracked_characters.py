@@ -0,0 +1,35 @@
+# Generated by Django 4.2.30 on 2026-10-19 19:01
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('corpstats', '0002_auto_20200720_0745'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrackedCharacter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('corporation_id', models.PositiveIntegerField()),
+                ('alliance_id', models.PositiveIntegerField(default=None, null=True)),
+                ('character_id', models.PositiveIntegerField()),
+                ('character_name', models.CharField(max_length=50)),
+                ('main_character_id', models.PositiveIntegerField(default=None, null=True)),
+                ('main_corporation_id', models.PositiveIntegerField(default=None, null=True)),
+                ('main_alliance_id', models.PositiveIntegerField(default=None, null=True)),
+                ('corpstats', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tracked_characters', to='corpstats.corpstat')),
+                ('user', models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'corporation_id'], name='corpstats_t_user_id_6ce828_idx'), models.Index(fields=['alliance_id', 'main_alliance_id'], name='corpstats_t_allianc_5db639_idx')],
+                'unique_together': {('corpstats', 'character_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-19 19:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpstats', '0003_tracked_characters'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='corpmember',
+            index=models.Index(fields=['corpstats', 'character_name', 'character_id'], name='corpstats_c_corpsta_84818f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='corpmember',
+            index=models.Index(fields=['corpstats', 'logon_date'], name='corpstats_c_corpsta_e50ad5_idx'),
+        ),
+    ]
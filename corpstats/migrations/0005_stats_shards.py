@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-19 20:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpstats', '0004_corpmember_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatsShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run', models.CharField(max_length=32)),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('totals', models.JSONField()),
+                ('corpstats', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='corpstats.corpstat')),
+            ],
+            options={
+                'unique_together': {('corpstats', 'run', 'shard')},
+            },
+        ),
+    ]
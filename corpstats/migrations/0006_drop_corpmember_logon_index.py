@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-19 20:20
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpstats', '0005_stats_shards'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='corpmember',
+            name='corpstats_c_corpsta_e50ad5_idx',
+        ),
+    ]
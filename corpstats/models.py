@@ -1,24 +1,34 @@
 import logging
 import os
 import json 
+import multiprocessing
+import tracemalloc
+from collections import namedtuple
+from functools import lru_cache
 from django.core.serializers.json import DjangoJSONEncoder
 
 from allianceauth.authentication.models import CharacterOwnership, UserProfile
+from django.contrib.auth.models import User
 from bravado.exception import HTTPForbidden
-from django.db import models
+from django.conf import settings
+from django.db import connection, connections, models, transaction
+from django.db.models import F, Q, Value
 from django.core.exceptions import ObjectDoesNotExist
 from jsonschema.exceptions import ValidationError
 from django.core.cache import cache
 from django.utils import timezone
 
-from esi.errors import TokenError
+from esi.errors import TokenError, IncompleteResponseError
 from esi.models import Token
 from allianceauth.eveonline.models import EveCorporationInfo, EveCharacter
 from allianceauth.notifications import notify
 
+from allianceauth import hooks
 from allianceauth.services.hooks import ServicesHook
 from allianceauth.eveonline.evelinks import eveimageserver
-from .managers import CorpStatManager
+from . import app_settings, local_cache
+from .managers import CorpStatManager, CorpMemberQuerySet, TrackedCharacterQuerySet
+from .permissions import get_permission_scope
 
 from .provider import esi
 
@@ -37,6 +47,291 @@ SERVICE_DB = {
     "teamspeak3":"teamspeak3",
 }
 
+def build_affiliation_cache_key(character_id):
+    return f"CORPSTAT_AFFILIATION_{character_id}"
+
+
+def update_affiliations(character_ids):
+    """
+    Look up the current corporation of all the characters in bulk and cache them for a short while
+
+    :return: dict of character_id: corporation_id
+    """
+    affiliations = {}
+    # ESI accepts up to 1000 ids per call
+    for i in range(0, len(character_ids), 1000):
+        for affiliation in esi.client.Character.post_characters_affiliation(
+                characters=character_ids[i:i + 1000]).result():
+            affiliations[affiliation['character_id']] = affiliation['corporation_id']
+    cache.set_many({build_affiliation_cache_key(c_id): corp_id for c_id, corp_id in affiliations.items()},
+                   app_settings.CORPSTATS_AFFILIATION_CACHE_TIME)
+    return affiliations
+
+
+def _pop_batches(items, size):
+    """
+    Yield `items` in batches of `size`, popping them off the list as they go
+    so rows that have been processed can be freed.
+    """
+    items.reverse()
+    while items:
+        yield [items.pop() for _ in range(min(size, len(items)))]
+
+
+ServiceRegistry = namedtuple('ServiceRegistry', ['hooks', 'services', 'relations'])
+_service_registry = None
+
+
+def get_service_registry():
+    """
+    Resolve the installed services against SERVICE_DB once per process,
+    only re-resolving if the registered services hooks change.
+
+    :return: ServiceRegistry of the countable services and their user relation names
+    """
+    global _service_registry
+    service_hooks = tuple(hooks.get_hooks('services_hook'))
+    if _service_registry is None or _service_registry.hooks != service_hooks:
+        services = []
+        relations = {}
+        for svc in ServicesHook.get_services():
+            if svc.name in SERVICE_DB:
+                services.append(svc.name)
+                relations[svc.name] = SERVICE_DB[svc.name]
+            else:
+                logger.error(f"Unknown Service {svc.name} Skipping")
+        _service_registry = ServiceRegistry(service_hooks, tuple(services), relations)
+    return _service_registry
+
+
+@lru_cache(maxsize=app_settings.CORPSTATS_PORTRAIT_CACHE_SIZE)
+def _character_portrait_url(character_id, size):
+    return eveimageserver.character_portrait_url(character_id, size=size)
+
+
+def character_portrait_url(character_id, size=32):
+    """
+    Memoised image server portrait url, a roster renders the same members portraits on several tabs.
+    Always memoised by position, so `size` passed either way shares an entry.
+    """
+    return _character_portrait_url(int(character_id), int(size))
+
+
+def _count_shard(args):
+    # runs in a pool process, so it takes the CorpStat pk rather than the instance
+    pk, user_range = args
+    cs = CorpStat.objects.select_related('corp').get(pk=pk)
+    registry = get_service_registry()
+    return cs.count_linked_characters(cs.get_linked_characters(registry, user_range), registry)
+
+
+def count_shard_totals(pk, user_range):
+    """
+    Totals of the users of one shard, small enough to pass between celery tasks. See `merge_shard_totals`.
+    """
+    members, mains, orphans, alt_count, services_count = _count_shard((pk, user_range))
+    return {'members': len(members), 'mains': len(mains), 'orphans': len(orphans), 'alts': alt_count,
+            'services': services_count}
+
+
+def merge_shard_totals(totals, services):
+    """
+    Add up the totals of each shard, users never span shards so mains don't overlap
+    """
+    merged = {'members': 0, 'mains': 0, 'orphans': 0, 'alts': 0, 'services': {service: 0 for service in services}}
+    for shard in totals:
+        for count in ('members', 'mains', 'orphans', 'alts'):
+            merged[count] += shard[count]
+        for service in services:
+            merged['services'][service] += shard['services'].get(service, 0)
+    return merged
+
+
+def get_percentages(authd_members, total_mains, total_unreg, alt_count, services_count, services):
+    """
+    :return: total_members, auth_percent, alt_ratio, service_percent
+    """
+    total_members = authd_members + total_unreg  # is unreg + known
+    # yay more math
+    auth_percent = authd_members/total_members*100
+    alt_ratio = 0
+
+    try:
+        alt_ratio = total_mains/alt_count
+    except:
+        pass
+    # services
+    service_percent = {}
+    for service in services:
+        try:
+            service_percent[service] = {"cnt":services_count[service], "percent":services_count[service]/total_mains*100}
+        except Exception as e:
+            service_percent[service] = {"cnt":services_count[service], "percent":0}
+    return total_members, auth_percent, alt_ratio, service_percent
+
+
+def merge_counts(partials, services):
+    """
+    Merge the counts of each shard, users never span shards so mains don't overlap
+    """
+    members = []
+    orphans = []
+    mains = {}
+    alt_count = 0
+    services_count = {service: 0 for service in services}
+    for p_members, p_mains, p_orphans, p_alt_count, p_services_count in partials:
+        members += p_members
+        orphans += p_orphans
+        mains.update(p_mains)
+        alt_count += p_alt_count
+        for service in services:
+            services_count[service] += p_services_count[service]
+    members.sort(key=lambda c: c.character_name)
+    orphans.sort(key=lambda c: c.character_name)
+    # serially mains are added when their first character by name comes up, keep that order
+    mains = dict(sorted(mains.items(), key=lambda m: m[1]['alts'][0].character_name))
+    return members, mains, orphans, alt_count, services_count
+
+
+# bumped whenever cached stats change outside of a CorpStat update
+STATS_REVISION_KEY = "CORPSTAT_REVISION"
+# bumped whenever a CorpStat is added or removed, or a state changes its members
+VISIBILITY_REVISION_KEY = "CORPSTAT_VISIBILITY_REVISION"
+
+
+def get_stats_revision():
+    return cache.get(STATS_REVISION_KEY, 0)
+
+
+def bump_visibility_revision():
+    cache.add(VISIBILITY_REVISION_KEY, 0, None)
+    cache.incr(VISIBILITY_REVISION_KEY)
+
+
+def get_visibility_version(user):
+    """
+    Everything the CorpStats visible to a user depend on, a cached visibility is only good for the same version
+    """
+    # worked out once per request and memoised on the user object, like the permission scope
+    version = getattr(user, '_corpstats_visibility_version', None)
+    if version is None:
+        profile = getattr(user, 'profile', None)
+        main = profile.main_character if profile else None
+        version = (cache.get(VISIBILITY_REVISION_KEY, 0), profile.state_id if profile else None,
+                   main.corporation_id if main else None, main.alliance_id if main else None)
+        user._corpstats_visibility_version = version
+    return version + (get_permission_scope(user),)
+
+
+def _empty_contribution():
+    return {'mains': 0, 'members': 0, 'alts': 0, 'orphans': 0, 'registered': 0, 'services': []}
+
+
+def get_user_contributions(corporation_ids, user_ids=None):
+    """
+    What each user adds to the stats of each corp, counted the same way as `CorpStat.get_stats`
+
+    :param corporation_ids: corps to count for
+    :param user_ids: only count these users, all linked users if None
+    :return: dict of corporation_id: {user_id: contribution}
+    """
+    main = 'character_ownership__user__profile__main_character'
+    chars = EveCharacter.objects.filter(Q(corporation_id__in=corporation_ids) |
+                                        Q(**{f'{main}__corporation_id__in': corporation_ids}),
+                                        **{f'{main}__isnull': False})
+    if user_ids is not None:
+        chars = chars.filter(character_ownership__user__in=user_ids)
+    chars = list(chars.values('character_id', 'corporation_id', user_id=F('character_ownership__user'),
+                              main_id=F(f'{main}__character_id'), main_corp_id=F(f'{main}__corporation_id')))
+
+    main_users = {c['user_id'] for c in chars if c['character_id'] == c['main_id']}
+    registry = get_service_registry()
+    service_users = {service: set(User.objects.filter(pk__in=main_users, **{f'{relation}__isnull': False})
+                                  .values_list('pk', flat=True)) if main_users else set()
+                     for service, relation in registry.relations.items()}
+
+    registered = CorpMember.objects.filter(corpstats__corp__corporation_id__in=corporation_ids).registered()
+    if user_ids is not None:
+        registered = registered.filter(character_id__in=[c['character_id'] for c in chars])
+    registered = set(registered.values_list('corpstats__corp__corporation_id', 'character_id'))
+
+    contributions = {corp_id: {} for corp_id in corporation_ids}
+    for c in chars:
+        for corp_id in {c['corporation_id'], c['main_corp_id']} & set(corporation_ids):
+            contribution = contributions[corp_id].setdefault(c['user_id'], _empty_contribution())
+            if c['main_corp_id'] == corp_id:
+                contribution['mains'] = 1
+                if c['character_id'] == c['main_id']:
+                    contribution['services'] = [s for s in registry.services if c['user_id'] in service_users[s]]
+            if c['corporation_id'] == corp_id:
+                contribution['members'] += 1
+                if c['character_id'] != c['main_id']:
+                    contribution['alts'] += 1
+                if c['main_corp_id'] != corp_id:
+                    contribution['orphans'] += 1
+            if (corp_id, c['character_id']) in registered:
+                contribution['registered'] += 1
+    return contributions
+
+
+def update_user_tracked_characters(user_id):
+    """
+    Refresh the owner and main of a users TrackedCharacters after an ownership or main change, instead of waiting
+    for their corps next update. Characters they no longer own lose their owner.
+    """
+    owned = list(EveCharacter.objects.filter(character_ownership__user_id=user_id)
+                 .values_list('character_id', flat=True))
+    main = UserProfile.objects.filter(user_id=user_id, main_character__isnull=False) \
+        .values_list('main_character__character_id', 'main_character__corporation_id',
+                     'main_character__alliance_id').first() or (None, None, None)
+    main = dict(zip(('main_character_id', 'main_corporation_id', 'main_alliance_id'), main))
+    TrackedCharacter.objects.filter(user_id=user_id).exclude(character_id__in=owned) \
+        .update(user=None, main_character_id=None, main_corporation_id=None, main_alliance_id=None)
+    if owned:
+        TrackedCharacter.objects.filter(character_id__in=owned).update(user_id=user_id, **main)
+
+
+def update_user_stats(user_id, corporation_ids=()):
+    """
+    Apply one users changes to the cached overview of the corps they are in, instead of recomputing those corps.
+    Concurrent changes can race, the next full recompute after an update corrects that.
+
+    :param corporation_ids: corps the change touched that the user may no longer have characters in,
+    like the corp of a character they just lost
+    """
+    corporation_ids = set(corporation_ids) | set(
+        EveCharacter.objects.filter(character_ownership__user_id=user_id).values_list('corporation_id', flat=True))
+    corpstats = list(CorpStat.objects.filter(corp__corporation_id__in=corporation_ids).select_related('corp'))
+    if not corpstats:
+        return
+
+    cached = cache.get_many([cs.build_cache_key() for cs in corpstats] +
+                            [cs.build_users_cache_key() for cs in corpstats])
+    cached_corpstats = [cs for cs in corpstats if cs.build_cache_key() in cached]
+    if cached_corpstats:
+        contributions = get_user_contributions([cs.corp.corporation_id for cs in cached_corpstats], user_ids=[user_id])
+    for cs in cached_corpstats:
+        users = cached.get(cs.build_users_cache_key())
+        if users is None:
+            # no contributions yet since the last full recompute, count every user of this corp once
+            users = {'tracked': cs.members.count(),
+                     'users': get_user_contributions([cs.corp.corporation_id])[cs.corp.corporation_id]}
+        else:
+            contribution = contributions[cs.corp.corporation_id].get(user_id)
+            if users['users'].get(user_id) == contribution:
+                continue
+            if contribution is None:
+                users['users'].pop(user_id, None)
+            else:
+                users['users'][user_id] = contribution
+        cs.cache_stats(cs.get_stats_from_users(users))
+        cache.set(cs.build_users_cache_key(), users, 43200)
+
+    # the corp pages list the users characters, so they changed even if no overview is cached or its counts didn't
+    cache.add(STATS_REVISION_KEY, 0, None)
+    cache.incr(STATS_REVISION_KEY)
+
+
 class CorpStat(models.Model):
     token = models.ForeignKey(Token, on_delete=models.CASCADE)
     corp = models.OneToOneField(EveCorporationInfo, on_delete=models.CASCADE)
@@ -59,67 +354,64 @@ class CorpStat(models.Model):
 
     def update(self):
         try:
+            # make sure the token is usable before we spend any calls on it
+            access_token = self.token.valid_access_token()
+
             # make sure the token owner is still in this corp
-            corp_id = esi.client.Character.get_characters_character_id( 
-                character_id=self.token.character_id).result()['corporation_id']
-            assert corp_id == int(self.corp.corporation_id)
+            assert self.get_owner_corporation_id() == int(self.corp.corporation_id)
 
             # get member tracking data and retrieve member ids for translation
             tracking = esi.client.Corporation.get_corporations_corporation_id_membertracking(
                 corporation_id=self.corp.corporation_id,
-                token=self.token.valid_access_token()).result()
-            member_ids = [t['character_id'] for t in tracking]
-
-            # requesting too many ids per call results in a HTTP400
-            # the swagger spec doesn't have a maxItems count
-            # manual testing says we can do over 350, but let's not risk it
-            member_id_chunks = [member_ids[i:i + 255] for i in range(0, len(member_ids), 255)]
-            member_name_chunks = [esi.client.Universe.post_universe_names(ids=id_chunk).result() for id_chunk in
-                                  member_id_chunks]
-
-            member_list = {t['character_id']: t for t in tracking}
-            for name_chunk in member_name_chunks:
-                for name in name_chunk:
-                    member_list[name['id']]['character_name'] = name.get('name', "")
-
-            # get ship and location names  
-            # TODO make this fast!
-            for t in tracking:
-                t['ship_type_name'] = ""
-                if 'ship_type_id' in t: # non req'd esi model
-                    if t['ship_type_id'] is not None:
-                        try:
-                            t['ship_type_name'] = esi.client.Universe.get_universe_types_type_id(type_id=t['ship_type_id']).result()['name'] #TODO use the inbuilt eve provider
-                        except ValidationError as e:
-                            logger.error(e)
-                            pass  # Bad id or crappy esi call...
-
-                #locations = c.Universe.post_universe_names(ids=[t['location_id']]).result()
-                #t['location_name'] = locations[0]['name'] if locations else ''  # might be a citadel we can't know about
-
-                member_list[t['character_id']].update(t)
-
-            # purge old members
-            old_members = CorpMember.objects.filter(corpstats=self)
-            if old_members.exists():
-                old_members._raw_delete(old_members.db)
-
-            member_db_create = []
-            # bulk update and create new member models
-            for c_id, data in member_list.items():
-                member_db_create.append(CorpMember(corpstats=self, **data))
-
-            CorpMember.objects.bulk_create(member_db_create)
+                token=access_token).result()
+
+            # fill in the names we already know locally before the old members are purged
+            for i in range(0, len(tracking), app_settings.CORPSTATS_UPDATE_BATCH_SIZE):
+                self._resolve_local_names(tracking[i:i + app_settings.CORPSTATS_UPDATE_BATCH_SIZE])
+
+            total = len(tracking)
+            batches = 0
+            seen = set()
+            ship_names = {}
+            trace_memory = app_settings.CORPSTATS_TRACE_MEMORY and not tracemalloc.is_tracing()
+            if trace_memory:
+                tracemalloc.start()
+            try:
+                # resolve the names from ESI before the transaction, so the purge doesn't hold its locks through them.
+                # That keeps every resolved row until the write, the whole roster is in memory as ESI's response
+                # anyway and the names are only added to those rows.
+                resolved = []
+                for batch in _pop_batches(tracking, app_settings.CORPSTATS_UPDATE_BATCH_SIZE):
+                    batch = [t for t in batch if t['character_id'] not in seen]
+                    seen.update(t['character_id'] for t in batch)
+                    self._resolve_member_names(batch)
+                    self._resolve_ship_names(batch, ship_names)
+                    resolved.append(batch)
+
+                with transaction.atomic():
+                    # purge old members
+                    old_members = CorpMember.objects.filter(corpstats=self)
+                    if old_members.exists():
+                        old_members._raw_delete(old_members.db)
+
+                    # the model instances are built a batch at a time, the written rows are dropped as we go
+                    while resolved:
+                        batch = resolved.pop(0)
+                        CorpMember.objects.bulk_create([CorpMember(corpstats=self, **t) for t in batch])
+                        batches += 1
+            finally:
+                if trace_memory:
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    logger.info("%s peak memory while writing members %s KiB" % (self, peak // 1024))
+            logger.info("%s updated %s members in %s batches" % (self, total, batches))
+
+            self.update_tracked_characters()
             # update the timer
             self.save()
 
         except TokenError as e:
-            logger.warning("%s failed to update: %s" % (self, e))
-            if self.token.user:
-                notify(self.token.user, "%s failed to update with your ESI token." % self,
-                       message="Your token has expired or is no longer valid. Please add a new one to create a new CorpStats.",
-                       level="error")
-            self.delete()
+            self._token_failed(e)
         except HTTPForbidden as e:
             logger.warning("%s failed to update: %s" % (self, e))
             if self.token.user:
@@ -127,73 +419,244 @@ class CorpStat(models.Model):
                        message="%s: %s" % (e.status_code, e.message), level="error")
             self.delete()
         except AssertionError as e:
-            logger.warning("%s token character no longer in corp." % self)
-            if self.token.user:
-                notify(self.token.user, "%s cannot update with your ESI token." % self,
-                       message="%s cannot update with your ESI token as you have left corp." % self, level="error")
-            self.delete()
+            self._owner_left()
+
+    def _resolve_local_names(self, batch):
+        """
+        fill in names from auth's characters, or our existing members where auth doesn't know them, in one query
+        """
+        member_ids = [t['character_id'] for t in batch]
+        rows = (EveCharacter.objects.filter(character_id__in=member_ids).order_by()
+                .annotate(from_auth=Value(True)).values_list('character_id', 'character_name', 'from_auth')
+                .union(CorpMember.objects.filter(corpstats=self, character_id__in=member_ids).order_by()
+                       .annotate(from_auth=Value(False)).values_list('character_id', 'character_name', 'from_auth')))
+        names = {}
+        for character_id, name, from_auth in rows:
+            # auth keeps its characters names current, a members name is only what it was when we resolved it
+            if name and (from_auth or character_id not in names):
+                names[character_id] = name
+        for t in batch:
+            if names.get(t['character_id']):
+                t['character_name'] = names[t['character_id']]
+
+    @staticmethod
+    def _resolve_member_names(batch):
+        """
+        ask ESI for any names we didn't know locally
+        """
+        member_ids = [t['character_id'] for t in batch if 'character_name' not in t]
+
+        # requesting too many ids per call results in a HTTP400
+        # the swagger spec doesn't have a maxItems count
+        # manual testing says we can do over 350, but let's not risk it
+        names = {}
+        for i in range(0, len(member_ids), 255):
+            for name in esi.client.Universe.post_universe_names(ids=member_ids[i:i + 255]).result():
+                names[name['id']] = name.get('name', "")
+
+        for t in batch:
+            if 'character_name' not in t:
+                t['character_name'] = names.get(t['character_id'], "")
+
+    @staticmethod
+    def _resolve_ship_names(batch, ship_names):
+        """
+        fill in ship names, `ship_names` is shared between batches so each type is only looked up once per update
+        """
+        for t in batch:
+            t['ship_type_name'] = ""
+            if t.get('ship_type_id') is not None: # non req'd esi model
+                if t['ship_type_id'] not in ship_names:
+                    try:
+                        ship_names[t['ship_type_id']] = esi.client.Universe.get_universe_types_type_id(type_id=t['ship_type_id']).result()['name'] #TODO use the inbuilt eve provider
+                    except ValidationError as e:
+                        logger.error(e)
+                        ship_names[t['ship_type_id']] = ""  # Bad id or crappy esi call...
+                t['ship_type_name'] = ship_names[t['ship_type_id']]
+
+            #locations = c.Universe.post_universe_names(ids=[t['location_id']]).result()
+            #t['location_name'] = locations[0]['name'] if locations else ''  # might be a citadel we can't know about
+
+    def check_token(self):
+        """
+        Pre-flight check for scheduled updates, refreshes the token if it has expired.
+
+        :return: True if the token is usable, False if this CorpStat should be skipped
+        """
+        try:
+            self.token.valid_access_token()
+            return True
+        except TokenError as e:
+            self._token_failed(e)
+        except IncompleteResponseError as e:
+            # SSO hiccup, leave it for the next run
+            logger.warning("%s token refresh incomplete, skipping: %s" % (self, e))
+        return False
+
+    def get_owner_corporation_id(self):
+        """
+        Corporation of the token owner, from the bulk affiliation cache if we have it
+        """
+        corp_id = cache.get(build_affiliation_cache_key(self.token.character_id))
+        if corp_id is None:
+            corp_id = esi.client.Character.get_characters_character_id(
+                character_id=self.token.character_id).result()['corporation_id']
+        return corp_id
+
+    def _owner_left(self):
+        logger.warning("%s token character no longer in corp." % self)
+        if self.token.user:
+            notify(self.token.user, "%s cannot update with your ESI token." % self,
+                   message="%s cannot update with your ESI token as you have left corp." % self, level="error")
+        self.delete()
+
+    def _token_failed(self, error):
+        logger.warning("%s failed to update: %s" % (self, error))
+        if self.token.user:
+            notify(self.token.user, "%s failed to update with your ESI token." % self,
+                   message="Your token has expired or is no longer valid. Please add a new one to create a new CorpStats.",
+                   level="error")
+        self.delete()
+
+    def update_tracked_characters(self):
+        """
+        Rebuild this corps slice of the alliance wide TrackedCharacter index from the current members
+        """
+        owners = EveCharacter.objects.filter(character_id__in=self.members.values('character_id'),
+                                             character_ownership__isnull=False) \
+            .values('character_id',
+                    user_id=F('character_ownership__user_id'),
+                    main_character_id=F('character_ownership__user__profile__main_character__character_id'),
+                    main_corporation_id=F('character_ownership__user__profile__main_character__corporation_id'),
+                    main_alliance_id=F('character_ownership__user__profile__main_character__alliance_id'))
+        owners = {o.pop('character_id'): o for o in owners}
+
+        TrackedCharacter.objects.filter(corpstats=self).delete()
+        TrackedCharacter.objects.bulk_create(
+            [TrackedCharacter(corpstats=self,
+                              corporation_id=self.corp.corporation_id,
+                              alliance_id=self.corp.alliance.alliance_id if self.corp.alliance_id else None,
+                              character_id=c_id,
+                              character_name=name,
+                              **owners.get(c_id, {}))
+             for c_id, name in self.members.values_list('character_id', 'character_name')],
+            batch_size=500)
 
     def build_cache_key(self):
         return f"CORPSTAT_{self.corp_id}"
+
+    def build_users_cache_key(self):
+        return f"CORPSTAT_{self.corp_id}_USERS"
+
+    def cache_stats(self, context):
+        cache.set(self.build_cache_key(), json.dumps({"date":timezone.now(), "data":context}, cls=DjangoJSONEncoder),43200)
+        local_cache.overviews.delete(self.pk)
+
+    def get_stats_from_users(self, users):
+        """
+        overview context from the per user contributions kept by `update_user_stats`
+        """
+        contributions = users['users'].values()
+        total_mains = sum(c['mains'] for c in contributions)
+        authd_members = sum(c['members'] for c in contributions)
+        alt_count = sum(c['alts'] for c in contributions)
+        total_members = authd_members + users['tracked'] - sum(c['registered'] for c in contributions)
+        service_percent = {}
+        for service in get_service_registry().services:
+            count = sum(service in c['services'] for c in contributions)
+            service_percent[service] = {"cnt":count, "percent":count/total_mains*100 if total_mains else 0}
+        return {
+                "corp_name":self.corp.corporation_name,
+                "total_mains":total_mains,
+                "total_members":total_members,
+                "authd_members":authd_members,
+                "auth_percent":authd_members/total_members*100 if total_members else 0,
+                "service_percent":service_percent,
+                "alt_ratio":total_mains/alt_count if alt_count else 0,
+                "orphan_count":sum(c['orphans'] for c in contributions)
+        }
     
     def get_cached_overview(self):
-        data = cache.get(self.build_cache_key, False)
+        # the overview also changes between updates, in whichever worker applies a users changes
+        version = (self.last_update, get_stats_revision())
+        overview = local_cache.overviews.get(self.pk, version)
+        if overview is not None:
+            return overview
+        data = cache.get(self.build_cache_key(), False)
         if data:
-            return json.loads(data)
+            overview = json.loads(data)
+            local_cache.overviews.set(self.pk, overview, version)
+            return overview
         else:
             return self.get_and_cache_stats(only_context=True)
 
     def get_and_cache_stats(self, only_context=False):
         members, mains, orphans, unregistered, total_mains, total_unreg, total_members, auth_percent, alt_ratio, service_percent, tracking, services = self.get_stats()
+        context = self._cache_context(total_mains, total_members, len(members), auth_percent, service_percent,
+                                      alt_ratio, len(orphans))
+        if only_context:
+            return {"date":timezone.now(), "data":context}
+
+        return members, mains, orphans, unregistered, total_mains, total_unreg, total_members, auth_percent, alt_ratio, service_percent, tracking, services
+
+    def _cache_context(self, total_mains, total_members, authd_members, auth_percent, service_percent, alt_ratio,
+                       orphan_count):
         context = {
                 "corp_name":self.corp.corporation_name,
                 "total_mains":total_mains,
                 "total_members":total_members,
-                "authd_members":len(members),
+                "authd_members":authd_members,
                 "auth_percent":auth_percent,
                 "service_percent":service_percent,
                 "alt_ratio":alt_ratio,
-                "orphan_count":len(orphans)
+                "orphan_count":orphan_count
         }
-        cache.set(self.build_cache_key, json.dumps({"date":timezone.now(), "data":context}, cls=DjangoJSONEncoder),43200)
-        if only_context:
-            return {"date":timezone.now(), "data":context}
-
-        return members, mains, orphans, unregistered, total_mains, total_unreg, total_members, auth_percent, alt_ratio, service_percent, tracking, services
+        self.cache_stats(context)
+        # contributions are rebuilt from this recompute the next time a user changes
+        cache.delete(self.build_users_cache_key())
+        return context
 
-    def get_stats(self):
+    def cache_shard_totals(self, totals):
         """
-        return all corpstats for corp
-
-        :return:
-        Mains with Alts Dict
-        Members List[EveCharacter]
-        Un-registered QuerySet[CorpMember]
+        Cache the stats from the totals of every shard, see `count_shard_totals`
+        """
+        services = list(get_service_registry().services)
+        merged = merge_shard_totals(totals, services)
+        total_members, auth_percent, alt_ratio, service_percent = get_percentages(
+            merged['members'], merged['mains'], self.members.unregistered().count(), merged['alts'],
+            merged['services'], services)
+        return self._cache_context(merged['mains'], total_members, merged['members'], auth_percent, service_percent,
+                                   alt_ratio, merged['orphans'])
+
+    def get_linked_characters(self, registry, user_range=None):
+        """
+        Every auth character counted in the stats of this corp, optionally only those of a (first, last) user id range
         """
-
         linked_chars = EveCharacter.objects.filter(corporation_id=self.corp.corporation_id)  # get all authenticated characters in corp from auth internals
         linked_chars = linked_chars | EveCharacter.objects.filter(
             character_ownership__user__profile__main_character__corporation_id=self.corp.corporation_id)  # add all alts for characters in corp
 
-        services = [svc.name for svc in ServicesHook.get_services()] # services list
+        services = list(registry.services) # services list
 
         linked_chars = linked_chars.select_related('character_ownership',
-                                                    'character_ownership__user__profile__main_character') \
-            .prefetch_related('character_ownership__user__character_ownerships') \
-        
-        skiped_services = []
+                                                    'character_ownership__user__profile__main_character')
+
         for service in services:
-            if service in SERVICE_DB:
-                linked_chars = linked_chars.select_related("character_ownership__user__{}".format(SERVICE_DB[service]))
-            else:
-                skiped_services.append(service)
-                logger.error(f"Unknown Service {service} Skipping")
+            linked_chars = linked_chars.select_related("character_ownership__user__{}".format(registry.relations[service]))
 
-        for service in skiped_services:
-            services.remove(service)
+        if user_range:
+            # only the characters of the users in this shard
+            linked_chars = linked_chars.filter(character_ownership__user__id__range=user_range)
 
-        linked_chars = linked_chars.order_by('character_name')  # order by name
+        return linked_chars.order_by('character_name')  # order by name
 
+    def count_linked_characters(self, linked_chars, registry):
+        """
+        Sort linked characters into members, mains and orphans and count alts and services
+
+        :return: members, mains, orphans, alt_count, services_count
+        """
+        services = list(registry.services) # services list
         members = [] # member list
         orphans = [] # orphan list
         alt_count = 0 # 
@@ -202,7 +665,6 @@ class CorpStat(models.Model):
             services_count[service] = 0 # prefill
 
         mains = {} # main list
-        temp_ids = [] # filter out linked vs unreg'd
         for char in linked_chars:
             try:
                 main = char.character_ownership.user.profile.main_character # main from profile
@@ -220,7 +682,7 @@ class CorpStat(models.Model):
                         if char.character_id == main.character_id:
                             for service in services:
                                 try:
-                                    if hasattr(char.character_ownership.user, SERVICE_DB[service]):
+                                    if hasattr(char.character_ownership.user, registry.relations[service]):
                                         mains[main.character_id]['services'][service] = True
                                         services_count[service] += 1
                                 except Exception as e:
@@ -235,40 +697,87 @@ class CorpStat(models.Model):
                         if main.corporation_id != self.corp.corporation_id:
                             orphans.append(char)
 
-                    temp_ids.append(char.character_id) # exclude from un-authed
-
             except ObjectDoesNotExist: # main not found we are unauthed
                 pass
 
-        unregistered = CorpMember.objects.filter(corpstats=self).exclude(character_id__in=temp_ids) # filter corpstat list for unknowns
-        tracking = CorpMember.objects.filter(corpstats=self).filter(character_id__in=temp_ids) # filter corpstat list for unknowns
+        return members, mains, orphans, alt_count, services_count
 
+    def get_user_ranges(self, shards):
+        """
+        Split the users with linked characters into up to `shards` contiguous id ranges of about the same size,
+        so each shard can use the user id index
 
-        # yay maths
-        total_mains = len(mains)
-        total_unreg = len(unregistered)
-        total_members = len(members) + total_unreg  # is unreg + known
-        # yay more math
-        auth_percent = len(members)/total_members*100
-        alt_ratio = 0
+        :return: list of (first, last) user ids
+        """
+        user_ids = sorted(set(self.get_linked_characters(get_service_registry())
+                              .values_list('character_ownership__user_id', flat=True)) - {None})
+        if not user_ids:
+            return []
+        size = -(-len(user_ids) // shards)
+        return [(user_ids[i], user_ids[min(i + size, len(user_ids)) - 1]) for i in range(0, len(user_ids), size)]
+
+    def count_in_shards(self, workers):
+        """
+        Count the linked characters in a pool of forked processes, each counting the users in one shard.
+        Only for management commands, forking a web or celery worker isn't safe, the update tasks fan the shards
+        out as celery tasks instead, see `tasks.recache_corpstats`.
 
+        :return: list of partial counts, or None if they can't be counted in parallel here
+        """
+        if multiprocessing.current_process().daemon or connection.in_atomic_block or \
+                (connection.vendor == 'sqlite' and connection.is_in_memory_db()):
+            return None
         try:
-            alt_ratio = total_mains/alt_count
-        except:
-            pass
-        # services
-        service_percent = {}
-        for service in services:
-            if service in SERVICE_DB:
-                try:
-                    service_percent[service] = {"cnt":services_count[service], "percent":services_count[service]/total_mains*100}
-                except Exception as e:
-                    service_percent[service] = {"cnt":services_count[service], "percent":0}
+            context = multiprocessing.get_context('fork')
+        except ValueError:  # platform can't fork
+            return None
+        ranges = self.get_user_ranges(workers)
+        if not ranges:
+            return None
+        # forked processes must not share the parents connections
+        connections.close_all()
+        try:
+            with context.Pool(len(ranges)) as pool:
+                return pool.map(_count_shard, [(self.pk, user_range) for user_range in ranges])
+        except Exception as e:
+            logger.warning("Counting %s in %s processes failed, counting serially: %s" % (self, workers, e))
+            return None
+
+    def get_stats(self):
+        """
+        return all corpstats for corp
+
+        :return:
+        Mains with Alts Dict
+        Members List[EveCharacter]
+        Un-registered QuerySet[CorpMember]
+        """
+
+        registry = get_service_registry()
+        services = list(registry.services) # services list
+
+        # always counted in the calling process, the update tasks shard large corps across celery instead
+        members, mains, orphans, alt_count, services_count = self.count_linked_characters(
+            self.get_linked_characters(registry), registry)
+
+        unregistered = self.members.unregistered() # filter corpstat list for unknowns
+        tracking = self.members.registered() # filter corpstat list for knowns
+
+        # yay maths
+        total_mains = len(mains)
+        total_unreg = unregistered.count()
+        total_members, auth_percent, alt_ratio, service_percent = get_percentages(
+            len(members), total_mains, total_unreg, alt_count, services_count, services)
 
         return members, mains, orphans, unregistered, total_mains, total_unreg, total_members, auth_percent, alt_ratio, service_percent, tracking, services
 
     def visible_to(self, user):
-        return CorpStat.objects.filter(pk=self.pk).visible_to(user).exists()
+        version = get_visibility_version(user)
+        visible = local_cache.visibility.get(user.pk, version)
+        if visible is None:
+            visible = frozenset(CorpStat.objects.visible_to(user).values_list('pk', flat=True))
+            local_cache.visibility.set(user.pk, visible, version)
+        return self.pk in visible
 
     def can_update(self, user):
         return self.token.user == user or self.visible_to(user)
@@ -301,19 +810,83 @@ class CorpMember(models.Model):
 
     corpstats = models.ForeignKey(CorpStat, on_delete=models.CASCADE, related_name='members')
 
+    objects = CorpMemberQuerySet.as_manager()
+
     class Meta:
         # not making character_id unique in case a character moves between two corps while only one updates
         unique_together = ('corpstats', 'character_id')
         ordering = ['character_name']
+        indexes = [
+            # members are always read per corp in name order, carry the id so the roster and
+            # the registered/unregistered splits can be served from the index alone
+            models.Index(fields=['corpstats', 'character_name', 'character_id']),
+        ]
 
     def __str__(self):
         return self.character_name
 
     def portrait_url(self, size=32):
-        return eveimageserver.character_portrait_url(self.character_id, size=size)
+        return character_portrait_url(self.character_id, size=size)
+
+    @property
+    def portrait_url_32(self):
+        return self.portrait_url(32)
+
+    @property
+    def portrait_url_64(self):
+        return self.portrait_url(64)
+
+    @property
+    def portrait_url_128(self):
+        return self.portrait_url(128)
 
     def __getattr__(self, item):
-        if item.startswith('portrait_url_'):
-            size = int(item.strip('portrait_url_'))
-            return self.portrait_url(size)
-        return self.__getattribute__(item)
+        # only reached for attributes that don't exist, keep any other portrait_url_<size> working
+        if item.startswith('portrait_url_') and item[13:].isdigit():
+            return self.portrait_url(int(item[13:]))
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{item}'")
+
+
+class StatsShard(models.Model):
+    """
+    Totals of one shard of a sharded recount, see `tasks.recache_corpstats`.
+    The rows of a run are deleted by the shard that caches its stats.
+    """
+    corpstats = models.ForeignKey(CorpStat, on_delete=models.CASCADE, related_name='+')
+    run = models.CharField(max_length=32)
+    shard = models.PositiveSmallIntegerField()
+    totals = models.JSONField()
+
+    class Meta:
+        unique_together = ('corpstats', 'run', 'shard')
+
+
+class TrackedCharacter(models.Model):
+    """
+    Alliance wide index of every character tracked by a CorpStat and who owns it.
+    Each corps rows are rebuilt whenever that corp updates.
+    """
+    corpstats = models.ForeignKey(CorpStat, on_delete=models.CASCADE, related_name='tracked_characters')
+    corporation_id = models.PositiveIntegerField()
+    alliance_id = models.PositiveIntegerField(null=True, default=None)
+
+    character_id = models.PositiveIntegerField()
+    character_name = models.CharField(max_length=50)
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, default=None, on_delete=models.SET_NULL,
+                             related_name='+')
+    main_character_id = models.PositiveIntegerField(null=True, default=None)
+    main_corporation_id = models.PositiveIntegerField(null=True, default=None)
+    main_alliance_id = models.PositiveIntegerField(null=True, default=None)
+
+    objects = TrackedCharacterQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('corpstats', 'character_id')
+        indexes = [
+            models.Index(fields=['user', 'corporation_id']),
+            models.Index(fields=['alliance_id', 'main_alliance_id']),
+        ]
+
+    def __str__(self):
+        return self.character_name
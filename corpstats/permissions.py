@@ -0,0 +1,34 @@
+from collections import namedtuple
+
+SCOPE_PERMISSIONS = ('view_corp_corpstats', 'view_alliance_corpstats', 'view_state_corpstats', 'view_all_corpstats',
+                     'add_corpstat')
+
+
+class PermissionScope(namedtuple('PermissionScope', ['view_corp', 'view_alliance', 'view_state', 'view_all', 'add'])):
+    """
+    The corpstats permissions of a user
+    """
+    __slots__ = ()
+
+    @property
+    def can_view(self):
+        return self.view_corp or self.view_alliance or self.view_state or self.view_all
+
+    @property
+    def in_menu(self):
+        return self.view_corp or self.view_alliance or self.view_state or self.add
+
+
+def get_permission_scope(user):
+    """
+    Permission scope of the user, worked out once per request and memoised on the user object. It isn't kept
+    between requests so a revoked permission is seen on the next one.
+    """
+    if user.is_active and user.is_superuser:
+        # has_perm doesn't ask the backends for superusers either
+        return PermissionScope(*(True for _ in SCOPE_PERMISSIONS))
+    scope = getattr(user, '_corpstats_permission_scope', None)
+    if scope is None:
+        scope = PermissionScope(*(user.has_perm(f'corpstats.{perm}') for perm in SCOPE_PERMISSIONS))
+        user._corpstats_permission_scope = scope
+    return scope
@@ -0,0 +1,135 @@
+import logging
+import re
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import connection, DatabaseError
+from django.utils import timezone
+
+from . import app_settings
+from .models import CorpStat, CorpMember, TrackedCharacter
+
+logger = logging.getLogger(__name__)
+
+# per corp cache keys and the CorpStat field their id is
+CORP_KEY_PATTERNS = (
+    (re.compile(r'^CORPSTAT_(?P<id>\d+)(_USERS|_ALTS_\d+(_\d+_\d+)?)?$'), 'corp_id'),
+    (re.compile(r'^CORPSTAT_REFRESH_(LOCK|STATUS)_(?P<id>\d+)$'), 'pk'),
+)
+
+# tables that grow with the number of tracked characters
+PRUNED_MODELS = (CorpMember, TrackedCharacter)
+
+
+def find_orphaned_keys(keys):
+    """
+    Per corp cache keys of corps that no longer have a CorpStat. Other keys are left alone.
+    """
+    corp_ids = set(CorpStat.objects.values_list('corp_id', flat=True))
+    pks = set(CorpStat.objects.values_list('pk', flat=True))
+    live = {'corp_id': corp_ids, 'pk': pks}
+    orphaned = []
+    for key in keys:
+        for pattern, field in CORP_KEY_PATTERNS:
+            match = pattern.match(key)
+            if match:
+                if int(match.group('id')) not in live[field]:
+                    orphaned.append(key)
+                break
+    return orphaned
+
+
+def prune_cache_keys():
+    """
+    Delete the cache keys of removed CorpStats. Only caches that can list their keys, like django-redis, can be pruned,
+    everything we cache expires on its own anyway.
+
+    :return: number of keys deleted, or None if the cache can't list its keys
+    """
+    if not hasattr(cache, 'iter_keys'):
+        logger.debug("Cache backend can't list keys, not pruning the corp stats cache.")
+        return None
+    orphaned = find_orphaned_keys(cache.iter_keys('CORPSTAT_*'))
+    if orphaned:
+        cache.delete_many(orphaned)
+    return len(orphaned)
+
+
+def prune_stale_corpstats(days):
+    """
+    Drop the members and tracked characters of CorpStats that haven't updated in `days` days, their next update
+    rebuilds them. The CorpStats and their tokens are kept.
+
+    :return: dict of model name: rows deleted
+    """
+    cutoff = timezone.now() - timedelta(days=days)
+    stale = list(CorpStat.objects.filter(last_update__lt=cutoff).only('pk', 'corp_id'))
+    rows = {}
+    for model in PRUNED_MODELS:
+        rows[model.__name__] = model.objects.filter(corpstats__in=stale).delete()[0] if stale else 0
+    if stale:
+        cache.delete_many([key for cs in stale for key in (cs.build_cache_key(), cs.build_users_cache_key())])
+    return rows
+
+
+def get_table_bytes():
+    """
+    Size of the data and indexes of the pruned tables, or None if the database can't tell us
+    """
+    tables = [model._meta.db_table for model in PRUNED_MODELS]
+    if connection.vendor == 'mysql':
+        sql = "SELECT SUM(data_length + index_length) FROM information_schema.tables " \
+              "WHERE table_schema = DATABASE() AND table_name IN (%s)" % ', '.join(['%s'] * len(tables))
+    elif connection.vendor == 'postgresql':
+        # pg_total_relation_size only takes a regclass, not the table name as text
+        sql = "SELECT SUM(pg_total_relation_size(t::regclass)) FROM unnest(ARRAY[%s]) AS t" \
+              % ', '.join(['%s'] * len(tables))
+    elif connection.vendor == 'sqlite':
+        # needs sqlite built with the dbstat table
+        sql = "SELECT SUM(pgsize) FROM dbstat WHERE name IN (SELECT name FROM sqlite_master WHERE tbl_name IN (%s))" \
+              % ', '.join(['%s'] * len(tables))
+    else:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, tables)
+            size = cursor.fetchone()[0]
+    except DatabaseError:
+        return None
+    return int(size) if size is not None else None
+
+
+def compact_tables():
+    """
+    Hand the space freed by deleted rows back, this locks the tables on mysql while it runs
+    """
+    tables = [connection.ops.quote_name(model._meta.db_table) for model in PRUNED_MODELS]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            cursor.execute("OPTIMIZE TABLE %s" % ', '.join(tables))
+            cursor.fetchall()
+        elif connection.vendor == 'postgresql':
+            for table in tables:
+                cursor.execute("VACUUM ANALYZE %s" % table)
+        elif connection.vendor == 'sqlite':
+            cursor.execute("VACUUM")
+
+
+def run_retention(days=None, compact=False):
+    """
+    Prune orphaned cache keys and the per corp data of stale CorpStats
+
+    :param days: days without an update before a CorpStats data is dropped, defaults to CORPSTATS_RETENTION_DAYS
+    :param compact: compact the tables afterwards, so the freed space is returned to the database
+    :return: dict of cache_keys, rows (per model) and bytes reclaimed, None where it can't be measured
+    """
+    days = app_settings.CORPSTATS_RETENTION_DAYS if days is None else days
+    size = get_table_bytes()
+    cache_keys = prune_cache_keys()
+    rows = prune_stale_corpstats(days) if days else {model.__name__: 0 for model in PRUNED_MODELS}
+    if compact:
+        compact_tables()
+    after = get_table_bytes()
+    reclaimed = size - after if size is not None and after is not None else None
+    logger.info("Corp stats retention pruned %s cache keys, %s rows and %s bytes" % (cache_keys, rows, reclaimed))
+    return {'cache_keys': cache_keys, 'rows': rows, 'bytes': reclaimed}
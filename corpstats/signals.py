@@ -0,0 +1,77 @@
+import logging
+
+from django.contrib.auth.models import User
+from django.core.exceptions import FieldDoesNotExist
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.dispatch import receiver
+
+from allianceauth.authentication.models import CharacterOwnership, State, UserProfile
+
+from allianceauth.eveonline.models import EveCharacter
+
+from .models import CorpStat, SERVICE_DB, bump_visibility_revision
+from .tasks import update_user_corpstats
+
+logger = logging.getLogger(__name__)
+
+
+def _user_changed(user_id, corporation_ids=()):
+    # only once the change is committed, a rolled back change must not end up in the cache,
+    # and in a worker, logins and profile saves shouldn't wait on the stats
+    transaction.on_commit(lambda: update_user_corpstats.delay(user_id, list(corporation_ids)))
+
+
+@receiver(post_save, sender=CharacterOwnership)
+@receiver(post_delete, sender=CharacterOwnership)
+def ownership_changed(sender, instance, *args, **kwargs):
+    logger.debug(f'Ownership of {instance.character_id} changed, updating corp stats of user {instance.user_id}')
+    try:
+        # a removed character is no longer among the users characters, pass its corp along
+        corporation_ids = [instance.character.corporation_id]
+    except EveCharacter.DoesNotExist:
+        corporation_ids = []
+    _user_changed(instance.user_id, corporation_ids)
+
+
+@receiver(post_save, sender=UserProfile)
+def main_character_changed(sender, instance, update_fields=None, *args, **kwargs):
+    # state changes save with update_fields=['state'] and don't change the stats
+    if update_fields is None or 'main_character' in update_fields:
+        _user_changed(instance.user_id)
+
+
+@receiver(post_save, sender=CorpStat)
+def corpstat_saved(sender, instance, created=False, *args, **kwargs):
+    # updates save every time, only a new CorpStat changes who sees what
+    if created:
+        transaction.on_commit(bump_visibility_revision)
+
+
+@receiver(post_delete, sender=CorpStat)
+def corpstat_deleted(sender, instance, *args, **kwargs):
+    transaction.on_commit(bump_visibility_revision)
+
+
+@receiver(m2m_changed, sender=State.member_corporations.through)
+@receiver(m2m_changed, sender=State.member_alliances.through)
+def state_members_changed(sender, action, *args, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        transaction.on_commit(bump_visibility_revision)
+
+
+def service_account_changed(sender, instance, *args, **kwargs):
+    _user_changed(instance.user_id)
+
+
+def connect_service_signals():
+    """
+    Watch the account models of every installed service we count
+    """
+    for relation in set(SERVICE_DB.values()):
+        try:
+            model = User._meta.get_field(relation).related_model
+        except FieldDoesNotExist:
+            continue  # service not installed
+        post_save.connect(service_account_changed, sender=model, dispatch_uid=f'corpstats_{relation}_saved')
+        post_delete.connect(service_account_changed, sender=model, dispatch_uid=f'corpstats_{relation}_deleted')
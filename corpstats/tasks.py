@@ -1,15 +1,177 @@
+import logging
+import uuid
+
+from bravado.exception import HTTPError, BravadoConnectionError, BravadoTimeoutError
 from celery import shared_task
-from .models import CorpStat
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from . import app_settings
+from .models import CorpStat, StatsShard, count_shard_totals, update_affiliations, update_user_stats, \
+    update_user_tracked_characters
+from .retention import run_retention
+
+logger = logging.getLogger(__name__)
 
 
 @shared_task
 def update_corpstats(pk):
-    cs = CorpStat.objects.get(pk=pk)
-    cs.update() # update
-    cs.get_and_cache_stats() # re-cache
+    # shares the lock of the manual refreshes, so the two never replace the members of a corp at the same time
+    if not cache.add(build_refresh_lock_key(pk), True, app_settings.CORPSTATS_REFRESH_LOCK_TIME):
+        logger.info("CorpStat %s is already updating, skipping the scheduled update" % pk)
+        return
+    try:
+        cs = CorpStat.objects.get(pk=pk)
+        cs.update() # update
+        if cs.pk is not None:
+            recache_corpstats(cs) # re-cache
+    finally:
+        cache.delete(build_refresh_lock_key(pk))
+
+
+def recache_corpstats(cs):
+    """
+    Re-cache the stats of a corp. With CORPSTATS_STATS_WORKERS above 1 its users are split into that many shards,
+    each counted by its own task. The shards keep their totals in StatsShard rows and the last one to finish caches
+    the stats, so neither an atomic cache incr nor a celery result backend is needed.
+    """
+    workers = app_settings.CORPSTATS_STATS_WORKERS
+    ranges = cs.get_user_ranges(workers) if workers > 1 else []
+    if len(ranges) < 2:
+        cs.get_and_cache_stats()
+        return
+    # runs that never finished, a shard failed or the corp has been recounted since
+    StatsShard.objects.filter(corpstats=cs).delete()
+    run = uuid.uuid4().hex
+    for shard, user_range in enumerate(ranges):
+        count_corpstats_shard.delay(cs.pk, run, shard, len(ranges), user_range)
+
+
+@shared_task
+def count_corpstats_shard(pk, run, shard, shards, user_range):
+    try:
+        totals = count_shard_totals(pk, user_range)
+        with transaction.atomic():
+            StatsShard.objects.create(corpstats_id=pk, run=run, shard=shard, totals=totals)
+    except (CorpStat.DoesNotExist, IntegrityError):
+        return  # the corp was removed, or the shard was delivered twice
+    rows = StatsShard.objects.filter(corpstats_id=pk, run=run)
+    totals = list(rows.values_list('totals', flat=True))
+    if len(totals) != shards:
+        return  # the last shard to finish caches the stats
+    # shards finishing together can both see every row, only the one whose delete takes them carries on
+    if rows.delete()[0] != shards:
+        return
+    cs = CorpStat.objects.filter(pk=pk).select_related('corp').first()
+    if cs is not None:
+        cs.cache_shard_totals(totals)
+
+
+@shared_task
+def update_user_corpstats(user_id, corporation_ids=()):
+    update_user_tracked_characters(user_id)
+    update_user_stats(user_id, corporation_ids)
+
+
+def build_refresh_lock_key(pk):
+    return f"CORPSTAT_REFRESH_LOCK_{pk}"
+
+
+def build_refresh_status_key(pk):
+    return f"CORPSTAT_REFRESH_STATUS_{pk}"
+
+
+def set_refresh_status(pk, status, error=None):
+    cache.set(build_refresh_status_key(pk), {'status': status, 'error': error, 'date': timezone.now()},
+              app_settings.CORPSTATS_REFRESH_LOCK_TIME)
+
+
+def get_refresh_status(pk):
+    """
+    :return: dict of status (queued, running, done or failed), error and date, or None if there was no manual update
+    """
+    return cache.get(build_refresh_status_key(pk))
+
+
+def queue_corpstats_refresh(pk):
+    """
+    Queue a manual update ahead of the scheduled ones, unless one is already queued or running for the corp
+
+    :return: True if an update was queued
+    """
+    if not cache.add(build_refresh_lock_key(pk), True, app_settings.CORPSTATS_REFRESH_LOCK_TIME):
+        return False
+    set_refresh_status(pk, 'queued')
+    try:
+        refresh_corpstats.apply_async(args=[pk], priority=app_settings.CORPSTATS_REFRESH_PRIORITY)
+    except Exception:
+        # nothing is going to run, don't block manual updates of the corp until the lock expires
+        cache.delete_many([build_refresh_lock_key(pk), build_refresh_status_key(pk)])
+        raise
+    return True
+
+
+@shared_task
+def refresh_corpstats(pk):
+    set_refresh_status(pk, 'running')
+    try:
+        cs = CorpStat.objects.get(pk=pk)
+        cs.update()
+        if cs.pk is None:
+            set_refresh_status(pk, 'failed', 'The corp stats were removed, check your notifications.')
+        else:
+            cs.get_and_cache_stats()
+            set_refresh_status(pk, 'done')
+    except HTTPError as e:
+        set_refresh_status(pk, 'failed', str(e))
+    except Exception:
+        set_refresh_status(pk, 'failed')
+        raise
+    finally:
+        cache.delete(build_refresh_lock_key(pk))
+
+
+def check_corpstats_tokens():
+    """
+    Validate and refresh every CorpStat token and make sure its owner is still
+    in the corp ahead of the scheduled updates, so no worker time is spent on
+    updates that are going to fail.
+
+    :return: pks of the CorpStats that are ready to update
+    """
+    ready = []
+    valid_tokens = set()  # tokens can be shared, only refresh them once
+    for cs in CorpStat.objects.select_related('token', 'token__user', 'corp'):
+        if cs.token_id in valid_tokens or cs.check_token():
+            valid_tokens.add(cs.token_id)
+            ready.append(cs)
+
+    # one bulk affiliation lookup for every token owner instead of a character lookup per update
+    try:
+        affiliations = update_affiliations(list({cs.token.character_id for cs in ready}))
+    except (HTTPError, BravadoConnectionError, BravadoTimeoutError) as e:
+        logger.warning("Bulk affiliation check failed, updates will check their own: %s" % e)
+        affiliations = {}
+
+    pks = []
+    for cs in ready:
+        corp_id = affiliations.get(cs.token.character_id)
+        if corp_id is not None and corp_id != cs.corp.corporation_id:
+            cs._owner_left()
+        else:
+            pks.append(cs.pk)
+    return pks
 
 
 @shared_task
 def update_all_corpstats():
-    for cs in CorpStat.objects.all():
-        update_corpstats.delay(cs.pk)
+    for pk in check_corpstats_tokens():
+        update_corpstats.delay(pk)
+
+
+@shared_task
+def prune_corpstats():
+    """
+    Prune orphaned cache keys and the members of corps that stopped updating, see `run_retention`
+    """
+    return run_retention()
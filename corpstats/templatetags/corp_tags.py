@@ -1,6 +1,8 @@
 from django import template
 from django.utils.dateparse import parse_datetime
 
+from ..models import character_portrait_url
+
 register = template.Library()
 
 @register.filter(name='str2date')
@@ -9,3 +11,16 @@ def str2date(date_str):
         return parse_datetime(date_str)
     except:
         return date_str
+
+
+@register.filter(name='member_portrait_url')
+def member_portrait_url(character_id, size=32):
+    """
+    Memoised drop in for evelinks' character_portrait_url, for rosters that render every member
+    """
+    if not character_id:
+        return ''
+    try:
+        return character_portrait_url(character_id, size)
+    except (TypeError, ValueError):
+        return ''
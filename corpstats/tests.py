@@ -1,15 +1,28 @@
+import json
+from datetime import timedelta
 from unittest import mock
 
-from django.test import TestCase
+from django.db import connection, transaction
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.utils.timezone import now
 from allianceauth.tests.auth_utils import AuthUtils
-from .models import CorpStat, CorpMember
+from . import app_settings, local_cache, models, retention
+from .auth_hooks import CorpStats as CorpStatsMenu
+from .models import CorpStat, CorpMember, StatsShard, TrackedCharacter, get_service_registry, STATS_REVISION_KEY
+from .permissions import get_permission_scope
+from .tasks import update_all_corpstats, update_corpstats, refresh_corpstats, build_refresh_lock_key, get_refresh_status, \
+    queue_corpstats_refresh, recache_corpstats, count_corpstats_shard
+from .views import access_corpstats_test
 from allianceauth.eveonline.models import EveCorporationInfo, EveAllianceInfo, EveCharacter
 from esi.models import Token
-from esi.errors import TokenError
+from esi.errors import TokenError, IncompleteResponseError
 from bravado.exception import HTTPForbidden
 from django.contrib.auth.models import User, Permission
-from allianceauth.authentication.models import CharacterOwnership
+from allianceauth.authentication.models import CharacterOwnership, UserProfile
 from django.core.cache import cache
 from .provider import esi
 from jsonschema.exceptions import ValidationError
@@ -107,10 +120,12 @@ class CorpStatsUpdateTestCase(TestCase):
         cls.token = Token.objects.create(user=cls.user, access_token='a', character_id=1, character_name='test character', character_owner_hash='z')
         cls.corp = EveCorporationInfo.objects.create(corporation_id=2, corporation_name='test corp', corporation_ticker='TEST', member_count=1)
         cache.clear()
+        local_cache.clear()
 
     def setUp(self):
         self.corpstat = CorpStat.objects.get_or_create(token=self.token, corp=self.corp)[0]
         cache.clear()
+        local_cache.clear()
         esi._client = None
 
     def test_can_update(self):
@@ -118,6 +133,7 @@ class CorpStatsUpdateTestCase(TestCase):
         self.corpstat.token.user = None
         self.assertFalse(self.corpstat.can_update(self.user))
         self.user.is_superuser = True
+        local_cache.clear()  # permission changes are only seen once the local cache expires
         self.assertTrue(self.corpstat.can_update(self.user))
         self.user.refresh_from_db()
         self.corpstat.token.refresh_from_db()
@@ -133,6 +149,24 @@ class CorpStatsUpdateTestCase(TestCase):
         self.corpstat.update()
         self.assertTrue(CorpMember.objects.filter(character_id=1, character_name='test character', corpstats=self.corpstat).exists())
 
+    @mock.patch('esi.clients.SwaggerClient')
+    def test_update_resolves_outside_transaction(self, SwaggerClient):
+        SwaggerClient.return_value.Character.get_characters_character_id.return_value.result.return_value = {'corporation_id': 2}
+        SwaggerClient.return_value.Corporation.get_corporations_corporation_id_membertracking.return_value.result.return_value = [
+            {'character_id': 1, 'ship_type_id': 2, 'logon_date': now(), 'logoff_date': now(), 'start_date': now()}]
+        depth = len(connection.atomic_blocks)
+        depths = []
+
+        def resolve(*args, **kwargs):
+            depths.append(len(connection.atomic_blocks))
+            return mock.Mock(**{'result.return_value': {'name': 'test ship'}})
+        SwaggerClient.return_value.Universe.get_universe_types_type_id.side_effect = resolve
+
+        self.corpstat.update()
+        # the members purge isn't holding its locks while ESI is asked for names
+        self.assertEqual(depths, [depth])
+        self.assertTrue(CorpMember.objects.filter(character_id=1, ship_type_name='test ship').exists())
+
     @mock.patch('esi.clients.SwaggerClient')
     def test_update_add_no_extras(self, SwaggerClient):
         SwaggerClient.return_value.Character.get_characters_character_id.return_value.result.return_value = {'corporation_id': 2}
@@ -154,6 +188,48 @@ class CorpStatsUpdateTestCase(TestCase):
         self.corpstat.update()
         self.assertFalse(CorpMember.objects.filter(character_id='2', corpstats=self.corpstat).exists())
 
+    @mock.patch('corpstats.app_settings.CORPSTATS_TRACE_MEMORY', True)
+    @mock.patch('corpstats.app_settings.CORPSTATS_UPDATE_BATCH_SIZE', 2)
+    @mock.patch('esi.clients.SwaggerClient')
+    def test_update_batches(self, SwaggerClient):
+        SwaggerClient.return_value.Character.get_characters_character_id.return_value.result.return_value = {'corporation_id': 2}
+        SwaggerClient.return_value.Corporation.get_corporations_corporation_id_membertracking.return_value.result.return_value = [
+            {'character_id': c_id, 'ship_type_id': 2, 'location_id': 3, 'logon_date': now(), 'logoff_date': now(), 'start_date': now()} for c_id in range(10, 15)]
+        SwaggerClient.return_value.Universe.get_universe_types_type_id.return_value.result.return_value = {'name': 'test ship'}
+        SwaggerClient.return_value.Universe.post_universe_names.return_value.result.side_effect = lambda: [
+            {'id': c_id, 'name': f'test character {c_id}', 'category': 'character'} for c_id in SwaggerClient.return_value.Universe.post_universe_names.call_args.kwargs['ids']]
+
+        self.corpstat.update()
+        self.assertEqual(SwaggerClient.return_value.Universe.post_universe_names.call_count, 3)
+        self.assertEqual(SwaggerClient.return_value.Universe.get_universe_types_type_id.call_count, 1)
+        self.assertEqual(CorpMember.objects.filter(corpstats=self.corpstat, ship_type_name='test ship').count(), 5)
+        self.assertEqual(CorpMember.objects.get(corpstats=self.corpstat, character_id=14).character_name, 'test character 14')
+
+    @mock.patch('esi.clients.SwaggerClient')
+    def test_update_local_names(self, SwaggerClient):
+        CorpMember.objects.create(character_id=2, character_name='old test character', corpstats=self.corpstat)
+        CorpMember.objects.create(character_id=1, character_name='test character before a rename', corpstats=self.corpstat)
+        SwaggerClient.return_value.Character.get_characters_character_id.return_value.result.return_value = {'corporation_id': 2}
+        SwaggerClient.return_value.Corporation.get_corporations_corporation_id_membertracking.return_value.result.return_value = [
+            {'character_id': c_id, 'ship_type_id': None, 'logon_date': now(), 'logoff_date': now(), 'start_date': now()} for c_id in (1, 2, 3)]
+        SwaggerClient.return_value.Universe.post_universe_names.return_value.result.return_value = [{'id': 3, 'name': 'new test character', 'category': 'character'}]
+
+        self.corpstat.update()
+        SwaggerClient.return_value.Universe.post_universe_names.assert_called_once_with(ids=[3])
+        self.assertEqual(CorpMember.objects.get(corpstats=self.corpstat, character_id=1).character_name, 'test character')
+        self.assertEqual(CorpMember.objects.get(corpstats=self.corpstat, character_id=2).character_name, 'old test character')
+        self.assertEqual(CorpMember.objects.get(corpstats=self.corpstat, character_id=3).character_name, 'new test character')
+
+    @mock.patch('esi.clients.SwaggerClient')
+    def test_update_all_names_local(self, SwaggerClient):
+        SwaggerClient.return_value.Character.get_characters_character_id.return_value.result.return_value = {'corporation_id': 2}
+        SwaggerClient.return_value.Corporation.get_corporations_corporation_id_membertracking.return_value.result.return_value = [
+            {'character_id': 1, 'ship_type_id': None, 'logon_date': now(), 'logoff_date': now(), 'start_date': now()}]
+
+        self.corpstat.update()
+        self.assertFalse(SwaggerClient.return_value.Universe.post_universe_names.called)
+        self.assertTrue(CorpMember.objects.filter(corpstats=self.corpstat, character_id=1, character_name='test character').exists())
+
     @mock.patch('corpstats.models.notify')
     @mock.patch('esi.clients.SwaggerClient')
     def test_update_deleted_token(self, SwaggerClient, notify):
@@ -181,6 +257,827 @@ class CorpStatsUpdateTestCase(TestCase):
         self.assertTrue(notify.called)
 
 
+class CorpStatsTokenCheckTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = AuthUtils.create_user('test')
+        AuthUtils.add_main_character(cls.user, 'test character', '1', corp_id='2', corp_name='test_corp', corp_ticker='TEST', alliance_id='3', alliance_name='TEST')
+        cls.token = Token.objects.create(user=cls.user, access_token='a', character_id=1, character_name='test character', character_owner_hash='z')
+        cls.corp = EveCorporationInfo.objects.create(corporation_id=2, corporation_name='test corp', corporation_ticker='TEST', member_count=1)
+        cls.corp2 = EveCorporationInfo.objects.create(corporation_id=4, corporation_name='another test corp', corporation_ticker='TEST2', member_count=1)
+
+    def setUp(self):
+        self.corpstat = CorpStat.objects.get_or_create(token=self.token, corp=self.corp)[0]
+        cache.clear()
+        local_cache.clear()
+        esi._client = None
+
+    @mock.patch('esi.clients.SwaggerClient')
+    @mock.patch('corpstats.tasks.update_corpstats')
+    @mock.patch('esi.models.Token.valid_access_token')
+    def test_valid_token_queued(self, valid_access_token, update_corpstats, SwaggerClient):
+        SwaggerClient.return_value.Character.post_characters_affiliation.return_value.result.return_value = []
+        CorpStat.objects.create(token=self.token, corp=self.corp2)
+        update_all_corpstats()
+        self.assertEqual(valid_access_token.call_count, 1)  # shared token only checked once
+        self.assertEqual(update_corpstats.delay.call_count, 2)
+
+    @mock.patch('corpstats.models.notify')
+    @mock.patch('corpstats.tasks.update_corpstats')
+    @mock.patch('esi.models.Token.valid_access_token')
+    def test_invalid_token_skipped(self, valid_access_token, update_corpstats, notify):
+        valid_access_token.side_effect = TokenError()
+        update_all_corpstats()
+        self.assertFalse(update_corpstats.delay.called)
+        self.assertFalse(CorpStat.objects.filter(corp=self.corp).exists())
+        self.assertTrue(notify.called)
+
+    @mock.patch('corpstats.tasks.update_corpstats')
+    @mock.patch('esi.models.Token.valid_access_token')
+    def test_incomplete_refresh_skipped(self, valid_access_token, update_corpstats):
+        valid_access_token.side_effect = IncompleteResponseError()
+        update_all_corpstats()
+        self.assertFalse(update_corpstats.delay.called)
+        self.assertTrue(CorpStat.objects.filter(corp=self.corp).exists())
+
+    @mock.patch('corpstats.models.notify')
+    @mock.patch('esi.clients.SwaggerClient')
+    @mock.patch('corpstats.tasks.update_corpstats')
+    @mock.patch('esi.models.Token.valid_access_token')
+    def test_owner_left_corp_skipped(self, valid_access_token, update_corpstats, SwaggerClient, notify):
+        SwaggerClient.return_value.Character.post_characters_affiliation.return_value.result.return_value = [{'character_id': 1, 'corporation_id': 4}]
+        update_all_corpstats()
+        self.assertFalse(update_corpstats.delay.called)
+        self.assertFalse(CorpStat.objects.filter(corp=self.corp).exists())
+        self.assertTrue(notify.called)
+
+    @mock.patch('esi.clients.SwaggerClient')
+    @mock.patch('corpstats.tasks.update_corpstats')
+    @mock.patch('esi.models.Token.valid_access_token')
+    def test_affiliation_cached_for_update(self, valid_access_token, update_corpstats, SwaggerClient):
+        SwaggerClient.return_value.Character.post_characters_affiliation.return_value.result.return_value = [{'character_id': 1, 'corporation_id': 2}]
+        update_all_corpstats()
+        self.assertEqual(self.corpstat.get_owner_corporation_id(), 2)
+        self.assertFalse(SwaggerClient.return_value.Character.get_characters_character_id.called)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CorpStatsQueryBudgetTestCase(TestCase):
+    """
+    Views and updates must not issue per-member or per-corp queries, so the
+    query count has to stay flat across roster sizes and inside the budget.
+    The cache is pinned to locmem so a DatabaseCache's queries aren't counted.
+    """
+    roster_sizes = (1, 4, 12)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = AuthUtils.create_user('budget viewer')
+        AuthUtils.add_main_character(cls.user, 'budget viewer', '1', corp_id='2', corp_name='test_corp', corp_ticker='TEST')
+        cls.user.user_permissions.add(Permission.objects.get_by_natural_key('view_all_corpstats', 'corpstats', 'corpstat'))
+        cls.token = Token.objects.create(user=cls.user, access_token='a', character_id=1, character_name='budget viewer', character_owner_hash='z')
+
+    def setUp(self):
+        esi._client = None
+        self.client.force_login(self.user)
+
+    def _build_roster(self, size):
+        """
+        `size` corps, each with `size` registered mains with an alt and `size` unregistered members
+        """
+        AuthUtils.disconnect_signals()
+        corpstats = []
+        for c in range(size):
+            corp_id = 1000 + c
+            corp = EveCorporationInfo.objects.create(corporation_id=corp_id, corporation_name=f'budget corp {c}', corporation_ticker='BDGT', member_count=size)
+            cs = CorpStat.objects.create(corp=corp, token=self.token)
+            for m in range(size):
+                user = AuthUtils.create_user(f'budget member {c} {m}')
+                char_id = 100000 + corp_id * 100 + m * 2
+                main = EveCharacter.objects.create(character_id=char_id, character_name=f'budget member {char_id}', corporation_id=corp_id, corporation_name=corp.corporation_name, corporation_ticker='BDGT')
+                alt = EveCharacter.objects.create(character_id=char_id + 1, character_name=f'budget member {char_id + 1}', corporation_id=corp_id, corporation_name=corp.corporation_name, corporation_ticker='BDGT')
+                CharacterOwnership.objects.create(character=main, user=user, owner_hash=f'budget{char_id}')
+                CharacterOwnership.objects.create(character=alt, user=user, owner_hash=f'budget{char_id + 1}')
+                user.profile.main_character = main
+                user.profile.save()
+                for char in (main, alt):
+                    CorpMember.objects.create(corpstats=cs, character_id=char.character_id, character_name=char.character_name, logon_date=now(), logoff_date=now(), start_date=now())
+                CorpMember.objects.create(corpstats=cs, character_id=900000 + corp_id * 100 + m, character_name=f'budget member unreg {corp_id} {m}', logon_date=now(), logoff_date=now(), start_date=now())
+            corpstats.append(cs)
+        AuthUtils.connect_signals()
+        return corpstats
+
+    def assertQueryBudget(self, budget, run, warm=True):
+        counts = {}
+        for size in self.roster_sizes:
+            with transaction.atomic():
+                corpstats = self._build_roster(size)
+                cache.clear()
+                local_cache.clear()
+                if warm:
+                    run(corpstats)
+                with CaptureQueriesContext(connection) as queries:
+                    run(corpstats)
+                counts[size] = len(queries)
+                transaction.set_rollback(True)
+        self.assertEqual(len(set(counts.values())), 1, f"Query count scales with roster size: {counts}")
+        self.assertLessEqual(max(counts.values()), budget, f"Query budget of {budget} exceeded: {counts}")
+
+    def test_corpstat_view(self):
+        def run(corpstats):
+            response = self.client.get(reverse('corpstat:view_corp', args=[corpstats[0].corp.corporation_id]))
+            self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget(27, run)
+
+    def test_overview_view(self):
+        def run(corpstats):
+            response = self.client.get(reverse('corpstat:view_all'))
+            self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget(19, run)
+
+    def test_corpstats_search(self):
+        def run(corpstats):
+            response = self.client.get(reverse('corpstat:search'), {'search_string': 'budget member'})
+            self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget(19, run)
+
+    def test_export_corpstats(self):
+        def run(corpstats):
+            response = self.client.get(reverse('corpstat:export', args=[corpstats[0].corp.corporation_id]))
+            self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget(15, run)
+
+    @mock.patch('esi.clients.SwaggerClient')
+    def test_update(self, SwaggerClient):
+        def run(corpstats):
+            cs = corpstats[0]
+            members = list(cs.members.values_list('character_id', 'character_name'))
+            SwaggerClient.return_value.Character.get_characters_character_id.return_value.result.return_value = {'corporation_id': cs.corp.corporation_id}
+            SwaggerClient.return_value.Corporation.get_corporations_corporation_id_membertracking.return_value.result.return_value = [
+                {'character_id': c_id, 'ship_type_id': 2, 'location_id': 3, 'logon_date': now(), 'logoff_date': now(), 'start_date': now()} for c_id, _ in members]
+            SwaggerClient.return_value.Universe.get_universe_types_type_id.return_value.result.return_value = {'name': 'test ship'}
+            SwaggerClient.return_value.Universe.post_universe_names.return_value.result.return_value = [
+                {'id': c_id, 'name': name, 'category': 'character'} for c_id, name in members]
+            cs.update()
+            self.assertTrue(cs.pk)
+        self.assertQueryBudget(12, run, warm=False)
+
+
+class CorpStatsViewsTestCase(TestCase):
+    """
+    Two corps and a user who can only see the first, shared by the view tests
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = AuthUtils.create_user('test')
+        cls.user.user_permissions.add(Permission.objects.get_by_natural_key('view_corp_corpstats', 'corpstats', 'corpstat'))
+        cls.corp = EveCorporationInfo.objects.create(corporation_id=2, corporation_name='test corp', corporation_ticker='TEST', member_count=3)
+        cls.corp2 = EveCorporationInfo.objects.create(corporation_id=4, corporation_name='another test corp', corporation_ticker='TEST2', member_count=1)
+        AuthUtils.disconnect_signals()
+        cls.main = EveCharacter.objects.create(character_id=1, character_name='test character', corporation_id=2, corporation_name='test corp', corporation_ticker='TEST')
+        cls.alt = EveCharacter.objects.create(character_id=10, character_name='test alt', corporation_id=2, corporation_name='test corp', corporation_ticker='TEST')
+        CharacterOwnership.objects.create(character=cls.main, user=cls.user, owner_hash='z')
+        CharacterOwnership.objects.create(character=cls.alt, user=cls.user, owner_hash='y')
+        cls.user.profile.main_character = cls.main
+        cls.user.profile.save()
+        AuthUtils.connect_signals()
+        cls.token = Token.objects.create(user=cls.user, access_token='a', character_id=1, character_name='test character', character_owner_hash='z')
+        cls.corpstat = CorpStat.objects.create(corp=cls.corp, token=cls.token)
+        cls.user2 = AuthUtils.create_user('test2')
+        AuthUtils.add_main_character(cls.user2, 'another test character', '5', corp_id='4', corp_name='another test corp', corp_ticker='TEST2')
+        cls.token2 = Token.objects.create(user=cls.user2, access_token='b', character_id=5, character_name='another test character', character_owner_hash='x')
+        cls.corpstat2 = CorpStat.objects.create(corp=cls.corp2, token=cls.token2)
+        for c_id, name, cs in ((1, 'test character', cls.corpstat), (10, 'test alt', cls.corpstat),
+                               (20, 'test unregistered', cls.corpstat), (30, 'hidden character', cls.corpstat2)):
+            CorpMember.objects.create(corpstats=cs, character_id=c_id, character_name=name, logon_date=now(), logoff_date=now(), start_date=now())
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+
+class CorpStatsApiTestCase(CorpStatsViewsTestCase):
+    def _ndjson(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+
+    def test_members(self):
+        rows = self._ndjson(self.client.get(reverse('corpstat:api_members')))
+        self.assertEqual([r['character_id'] for r in rows], [1, 10, 20])
+        self.assertEqual(rows[1]['main_character_id'], 1)
+        self.assertEqual(rows[1]['corporation_id'], 2)
+        self.assertIsNone(rows[2]['main_character_id'])
+
+    def test_unregistered(self):
+        rows = self._ndjson(self.client.get(reverse('corpstat:api_unregistered')))
+        self.assertEqual([r['character_id'] for r in rows], [20])
+
+    def test_keyset_pagination(self):
+        response = self.client.get(reverse('corpstat:api_members'), {'limit': 2, 'format': 'json'})
+        page = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([r['character_id'] for r in page['results']], [1, 10])
+        # an update in between recreates the members with new pks, the cursor still holds
+        members = list(CorpMember.objects.values('corpstats_id', 'character_id', 'character_name'))
+        CorpMember.objects.all().delete()
+        CorpMember.objects.bulk_create([CorpMember(**m) for m in members])
+        response = self.client.get(reverse('corpstat:api_members'), {'limit': 2, 'format': 'json', 'after': page['next']})
+        page = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([r['character_id'] for r in page['results']], [20])
+        self.assertIsNone(page['next'])
+
+    def test_mains(self):
+        rows = self._ndjson(self.client.get(reverse('corpstat:api_mains')))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['character_id'], 1)
+        self.assertEqual([a['character_id'] for a in rows[0]['alts']], [10, 1])
+
+    def test_bad_page(self):
+        response = self.client.get(reverse('corpstat:api_members'), {'limit': 'all'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('corpstat:api_members'), {'after': '10'})
+        self.assertEqual(response.status_code, 400)
+
+
+class CorpStatsLazyMainsTestCase(CorpStatsViewsTestCase):
+    def test_alts(self):
+        cache.clear()
+        local_cache.clear()
+        response = self.client.get(reverse('corpstat:alts', args=[2, 1]))
+        self.assertEqual(response.status_code, 200)
+        alts = response.json()['alts']
+        self.assertEqual([a['character_id'] for a in alts], [10, 1])
+        self.assertIsNone(alts[0]['alliance_logo_url'])
+        # served from the cache until it expires
+        CharacterOwnership.objects.filter(character=self.alt).delete()
+        self.assertEqual(len(self.client.get(reverse('corpstat:alts', args=[2, 1])).json()['alts']), 2)
+        # or the users changes are applied to the stats
+        cache.add(STATS_REVISION_KEY, 0, None)
+        cache.incr(STATS_REVISION_KEY)
+        self.assertEqual(len(self.client.get(reverse('corpstat:alts', args=[2, 1])).json()['alts']), 1)
+
+    def test_alts_after_update(self):
+        cache.clear()
+        self.assertEqual(len(self.client.get(reverse('corpstat:alts', args=[2, 1])).json()['alts']), 2)
+        CharacterOwnership.objects.filter(character=self.alt).delete()
+        self.corpstat.save()  # updated
+        self.assertEqual(len(self.client.get(reverse('corpstat:alts', args=[2, 1])).json()['alts']), 1)
+
+    def test_alts_not_visible(self):
+        self.assertEqual(self.client.get(reverse('corpstat:alts', args=[4, 5])).status_code, 403)
+        self.assertEqual(self.client.get(reverse('corpstat:alts', args=[2, 10])).status_code, 404)
+
+    def test_lazy_mains(self):
+        with mock.patch.object(app_settings, 'CORPSTATS_LAZY_MAINS', True):
+            response = self.client.get(reverse('corpstat:view_corp', args=[2]))
+        self.assertContains(response, reverse('corpstat:alts', args=[2, 1]))
+        response = self.client.get(reverse('corpstat:view_corp', args=[2]))
+        self.assertNotContains(response, reverse('corpstat:alts', args=[2, 1]))
+
+
+class CorpStatsConditionalTestCase(CorpStatsViewsTestCase):
+    def test_conditional_corpstat_view(self):
+        url = reverse('corpstat:view_corp', args=[2])
+        etag = self.client.get(url)['ETag']
+        with mock.patch.object(CorpStat, 'get_stats') as get_stats:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        get_stats.assert_not_called()
+        self.assertEqual(self.client.get(reverse('corpstat:view_all'), HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.corpstat.save()  # updated
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_conditional_scope(self):
+        url = reverse('corpstat:view_all')
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.user.user_permissions.add(Permission.objects.get_by_natural_key('view_all_corpstats', 'corpstats', 'corpstat'))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_scope_not_modified_since(self):
+        # the scope and revision aren't dates, so the scoped pages only answer to their etag
+        response = self.client.get(reverse('corpstat:view_corp', args=[2]))
+        self.assertFalse(response.has_header('Last-Modified'))
+        self.assertEqual(self.client.get(reverse('corpstat:view_corp', args=[2]),
+                                         HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT').status_code, 200)
+
+    def test_conditional_export(self):
+        url = reverse('corpstat:export', args=[2])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+
+class CorpStatsVisibilityCacheTestCase(CorpStatsViewsTestCase):
+    def test_new_corpstat_visible(self):
+        self.user.user_permissions.add(Permission.objects.get_by_natural_key('view_all_corpstats', 'corpstats', 'corpstat'))
+        self.assertTrue(self.corpstat.visible_to(User.objects.get(pk=self.user.pk)))
+        with self.captureOnCommitCallbacks(execute=True):
+            corp = EveCorporationInfo.objects.create(corporation_id=6, corporation_name='new corp', corporation_ticker='NEW', member_count=1)
+            corpstat = CorpStat.objects.create(corp=corp, token=self.token2)
+        self.assertTrue(corpstat.visible_to(User.objects.get(pk=self.user.pk)))
+
+    def test_version_once_per_request(self):
+        user = User.objects.get(pk=self.user.pk)
+        self.corpstat.visible_to(user)
+        with self.assertNumQueries(0):
+            self.corpstat.visible_to(user)
+            self.corpstat2.visible_to(user)
+
+    def test_state_members_changed(self):
+        self.user.user_permissions.add(Permission.objects.get_by_natural_key('view_state_corpstats', 'corpstats', 'corpstat'))
+        self.assertFalse(self.corpstat2.visible_to(User.objects.get(pk=self.user.pk)))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.profile.state.member_corporations.add(self.corp2)
+        self.assertTrue(self.corpstat2.visible_to(User.objects.get(pk=self.user.pk)))
+
+
+class CorpStatsRefreshTestCase(CorpStatsViewsTestCase):
+    @mock.patch('corpstats.tasks.refresh_corpstats')
+    def test_update_queued_once(self, refresh):
+        cache.clear()
+        for _ in range(2):
+            response = self.client.get(reverse('corpstat:update', args=[2]))
+            self.assertRedirects(response, reverse('corpstat:view_corp', args=[2]), fetch_redirect_response=False)
+        refresh.apply_async.assert_called_once_with(args=[self.corpstat.pk], priority=app_settings.CORPSTATS_REFRESH_PRIORITY)
+        self.assertEqual(self.client.get(reverse('corpstat:update_status', args=[2])).json()['status'], 'queued')
+        self.assertEqual(self.client.get(reverse('corpstat:update_status', args=[4])).status_code, 403)
+
+    @mock.patch('corpstats.tasks.refresh_corpstats')
+    def test_update_queue_failed(self, refresh):
+        cache.clear()
+        refresh.apply_async.side_effect = ConnectionError
+        with self.assertRaises(ConnectionError):
+            queue_corpstats_refresh(self.corpstat.pk)
+        # the next manual update isn't blocked by an update that never got queued
+        self.assertIsNone(cache.get(build_refresh_lock_key(self.corpstat.pk)))
+        self.assertIsNone(get_refresh_status(self.corpstat.pk))
+
+    @mock.patch.object(CorpStat, 'get_and_cache_stats')
+    @mock.patch.object(CorpStat, 'update')
+    def test_refresh(self, update, get_and_cache_stats):
+        cache.clear()
+        cache.add(build_refresh_lock_key(self.corpstat.pk), True)
+        refresh_corpstats(self.corpstat.pk)
+        self.assertTrue(update.called)
+        self.assertEqual(self.client.get(reverse('corpstat:update_status', args=[2])).json()['status'], 'done')
+        self.assertIsNone(cache.get(build_refresh_lock_key(self.corpstat.pk)))
+
+    @mock.patch.object(CorpStat, 'get_and_cache_stats')
+    @mock.patch.object(CorpStat, 'update')
+    def test_scheduled_update_locked(self, update, get_and_cache_stats):
+        cache.clear()
+        cache.add(build_refresh_lock_key(self.corpstat.pk), True)  # a manual refresh is running
+        update_corpstats(self.corpstat.pk)
+        self.assertFalse(update.called)
+        cache.delete(build_refresh_lock_key(self.corpstat.pk))
+        update_corpstats(self.corpstat.pk)
+        self.assertTrue(update.called)
+        # and the manual refresh can be queued again afterwards
+        self.assertIsNone(cache.get(build_refresh_lock_key(self.corpstat.pk)))
+
+    @mock.patch.object(CorpStat, 'update', side_effect=ValueError)
+    def test_refresh_failed(self, update):
+        cache.clear()
+        cache.add(build_refresh_lock_key(self.corpstat.pk), True)
+        with self.assertRaises(ValueError):
+            refresh_corpstats(self.corpstat.pk)
+        self.assertEqual(self.client.get(reverse('corpstat:update_status', args=[2])).json()['status'], 'failed')
+        self.assertIsNone(cache.get(build_refresh_lock_key(self.corpstat.pk)))
+
+
+class TrackedCharacterTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alliance = EveAllianceInfo.objects.create(alliance_id=3, alliance_name='test alliance', alliance_ticker='TEST', executor_corp_id=2)
+        cls.corp = EveCorporationInfo.objects.create(corporation_id=2, corporation_name='test corp', corporation_ticker='TEST', alliance=cls.alliance, member_count=3)
+        cls.corp2 = EveCorporationInfo.objects.create(corporation_id=4, corporation_name='another test corp', corporation_ticker='TEST2', alliance=cls.alliance, member_count=1)
+        cls.user = AuthUtils.create_user('test')
+        cls.user2 = AuthUtils.create_user('test2')
+        AuthUtils.disconnect_signals()
+        chars = {}
+        for c_id, corp_id, alliance_id, user in ((1, 2, 3, cls.user), (2, 4, 3, cls.user), (5, 7, None, cls.user2), (6, 2, 3, cls.user2)):
+            chars[c_id] = EveCharacter.objects.create(character_id=c_id, character_name=f'test character {c_id}', corporation_id=corp_id, corporation_name='test', corporation_ticker='TEST', alliance_id=alliance_id)
+            CharacterOwnership.objects.create(character=chars[c_id], user=user, owner_hash=f'hash{c_id}')
+        cls.user.profile.main_character = chars[1]
+        cls.user.profile.save()
+        cls.user2.profile.main_character = chars[5]
+        cls.user2.profile.save()
+        AuthUtils.connect_signals()
+        cls.chars = chars
+        cls.token = Token.objects.create(user=cls.user, access_token='a', character_id=1, character_name='test character 1', character_owner_hash='hash1')
+        cls.corpstat = CorpStat.objects.create(corp=cls.corp, token=cls.token)
+        cls.corpstat2 = CorpStat.objects.create(corp=cls.corp2, token=cls.token)
+        for c_id, cs in ((1, cls.corpstat), (6, cls.corpstat), (20, cls.corpstat), (2, cls.corpstat2)):
+            CorpMember.objects.create(corpstats=cs, character_id=c_id, character_name=f'test character {c_id}')
+
+    def setUp(self):
+        self.corpstat.update_tracked_characters()
+        self.corpstat2.update_tracked_characters()
+
+    def test_index_built(self):
+        tracked = TrackedCharacter.objects.get(corpstats=self.corpstat, character_id=6)
+        self.assertEqual(tracked.user, self.user2)
+        self.assertEqual(tracked.main_character_id, 5)
+        self.assertEqual(tracked.alliance_id, 3)
+        unregistered = TrackedCharacter.objects.get(corpstats=self.corpstat, character_id=20)
+        self.assertIsNone(unregistered.user)
+
+    def test_rebuild_only_touches_own_corp(self):
+        CorpMember.objects.filter(corpstats=self.corpstat, character_id=6).delete()
+        self.corpstat.update_tracked_characters()
+        self.assertFalse(TrackedCharacter.objects.filter(character_id=6).exists())
+        self.assertTrue(TrackedCharacter.objects.filter(corpstats=self.corpstat2, character_id=2).exists())
+
+    def test_main_outside_alliance(self):
+        outside = TrackedCharacter.objects.main_outside_alliance(3)
+        self.assertEqual([t.character_id for t in outside], [6])
+        # a user without a main has no main outside the alliance
+        UserProfile.objects.filter(user=self.user2).update(main_character=None)
+        self.corpstat.update_tracked_characters()
+        self.assertFalse(TrackedCharacter.objects.main_outside_alliance(3).exists())
+
+    def test_ownership_changed(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            CharacterOwnership.objects.filter(character_id=self.chars[6].pk).update(user=self.user)
+            CharacterOwnership.objects.get(character_id=self.chars[6].pk).save()
+        tracked = TrackedCharacter.objects.get(corpstats=self.corpstat, character_id=6)
+        self.assertEqual(tracked.user, self.user)
+        self.assertEqual(tracked.main_character_id, 1)
+        self.assertFalse(TrackedCharacter.objects.main_outside_alliance(3).exists())
+        with self.captureOnCommitCallbacks(execute=True):
+            CharacterOwnership.objects.filter(character_id=self.chars[6].pk).delete()
+        tracked.refresh_from_db()
+        self.assertIsNone(tracked.user)
+        self.assertIsNone(tracked.main_character_id)
+
+    def test_main_changed(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user2.profile.main_character = self.chars[6]
+            self.user2.profile.save()
+        tracked = TrackedCharacter.objects.get(corpstats=self.corpstat, character_id=6)
+        self.assertEqual(tracked.main_character_id, 6)
+        self.assertEqual(tracked.main_alliance_id, 3)
+        self.assertFalse(TrackedCharacter.objects.main_outside_alliance(3).exists())
+
+    def test_users_in_corps(self):
+        users = TrackedCharacter.objects.users_in_corps(2)
+        self.assertEqual(list(users), [{'user': self.user.pk, 'corps': 2}])
+
+    def test_registered_members(self):
+        # 6 is registered through its own corp, 2 through its mains corp
+        self.assertEqual(list(CorpMember.objects.registered().values_list('character_id', flat=True).order_by('character_id')), [1, 2, 6])
+        self.assertEqual(list(CorpMember.objects.unregistered().values_list('character_id', flat=True)), [20])
+        members, mains, orphans, unregistered, total_mains, total_unreg, total_members, auth_percent, alt_ratio, service_percent, tracking, services = self.corpstat.get_stats()
+        self.assertEqual([m.character_id for m in unregistered], [20])
+        self.assertEqual(sorted(m.character_id for m in tracking), [1, 6])
+        self.assertEqual(total_unreg, 1)
+        self.assertEqual(total_members, 3)
+
+
+class RetentionTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.corp = EveCorporationInfo.objects.create(corporation_id=2, corporation_name='test corp', corporation_ticker='TEST', member_count=2)
+        cls.corp2 = EveCorporationInfo.objects.create(corporation_id=4, corporation_name='another test corp', corporation_ticker='TEST2', member_count=1)
+        cls.user = AuthUtils.create_user('test')
+        EveCharacter.objects.create(character_id=1, character_name='test character 1', corporation_id=2, corporation_name='test corp', corporation_ticker='TEST')
+        cls.token = Token.objects.create(user=cls.user, access_token='a', character_id=1, character_name='test character 1', character_owner_hash='hash1')
+        cls.corpstat = CorpStat.objects.create(corp=cls.corp, token=cls.token)
+        cls.corpstat2 = CorpStat.objects.create(corp=cls.corp2, token=cls.token)
+        for c_id, cs in ((1, cls.corpstat), (6, cls.corpstat), (2, cls.corpstat2)):
+            CorpMember.objects.create(corpstats=cs, character_id=c_id, character_name=f'test character {c_id}')
+
+    def setUp(self):
+        cache.clear()
+        self.corpstat.update_tracked_characters()
+        self.corpstat2.update_tracked_characters()
+
+    def test_find_orphaned_keys(self):
+        removed = self.corpstat.corp_id + self.corpstat2.corp_id
+        keys = [f"CORPSTAT_{self.corpstat.corp_id}", f"CORPSTAT_{self.corpstat.corp_id}_ALTS_1_1700000000_3",
+                f"CORPSTAT_{removed}", f"CORPSTAT_{removed}_USERS", f"CORPSTAT_{removed}_ALTS_1_1700000000_3",
+                f"CORPSTAT_REFRESH_STATUS_{self.corpstat2.pk}", "CORPSTAT_REFRESH_LOCK_999",
+                STATS_REVISION_KEY, "CORPSTAT_AFFILIATION_1"]
+        self.assertEqual(retention.find_orphaned_keys(keys),
+                         [f"CORPSTAT_{removed}", f"CORPSTAT_{removed}_USERS", f"CORPSTAT_{removed}_ALTS_1_1700000000_3",
+                          "CORPSTAT_REFRESH_LOCK_999"])
+
+    def test_prune_cache_keys(self):
+        with mock.patch('corpstats.retention.cache') as mock_cache:
+            mock_cache.iter_keys.return_value = iter([f"CORPSTAT_{self.corpstat.corp_id}", "CORPSTAT_999"])
+            self.assertEqual(retention.prune_cache_keys(), 1)
+        mock_cache.iter_keys.assert_called_once_with('CORPSTAT_*')
+        mock_cache.delete_many.assert_called_once_with(["CORPSTAT_999"])
+
+    def test_prune_cache_keys_needs_key_listing(self):
+        # the local memory cache of the tests can't list its keys
+        self.assertIsNone(retention.prune_cache_keys())
+
+    def test_prune_stale_corpstats(self):
+        CorpStat.objects.filter(pk=self.corpstat.pk).update(last_update=now() - timedelta(days=100))
+        cache.set(self.corpstat.build_cache_key(), 'stale')
+        report = retention.run_retention(days=90)
+        self.assertEqual(report['rows'], {'CorpMember': 2, 'TrackedCharacter': 2})
+        self.assertIsNone(cache.get(self.corpstat.build_cache_key()))
+        self.assertTrue(CorpStat.objects.filter(pk=self.corpstat.pk).exists())
+        self.assertEqual(list(CorpMember.objects.values_list('character_id', flat=True)), [2])
+        self.assertEqual(list(TrackedCharacter.objects.values_list('character_id', flat=True)), [2])
+
+    def test_table_bytes_postgres(self):
+        with mock.patch.object(connection, 'vendor', 'postgresql'), \
+                mock.patch.object(connection, 'cursor') as cursor:
+            cursor.return_value.__enter__.return_value.fetchone.return_value = (8192,)
+            self.assertEqual(retention.get_table_bytes(), 8192)
+        sql, tables = cursor.return_value.__enter__.return_value.execute.call_args[0]
+        self.assertIn('pg_total_relation_size(t::regclass)', sql)
+        self.assertEqual(tables, ['corpstats_corpmember', 'corpstats_trackedcharacter'])
+
+    def test_retention_disabled(self):
+        CorpStat.objects.update(last_update=now() - timedelta(days=100))
+        report = retention.run_retention(days=0)
+        self.assertEqual(report['rows'], {'CorpMember': 0, 'TrackedCharacter': 0})
+        self.assertEqual(CorpMember.objects.count(), 3)
+
+
+class CorpStatsIncrementalTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.corp = EveCorporationInfo.objects.create(corporation_id=2, corporation_name='test corp', corporation_ticker='TEST', member_count=3)
+        cls.user = AuthUtils.create_user('test')
+        cls.user2 = AuthUtils.create_user('test2')
+        AuthUtils.disconnect_signals()
+        cls.chars = {}
+        for c_id, corp_id, user in ((1, 2, cls.user), (2, 4, cls.user), (5, 7, cls.user2), (6, 2, cls.user2)):
+            cls.chars[c_id] = EveCharacter.objects.create(character_id=c_id, character_name=f'test character {c_id}', corporation_id=corp_id, corporation_name='test', corporation_ticker='TEST')
+            CharacterOwnership.objects.create(character=cls.chars[c_id], user=user, owner_hash=f'hash{c_id}')
+        cls.user.profile.main_character = cls.chars[1]
+        cls.user.profile.save()
+        cls.user2.profile.main_character = cls.chars[5]
+        cls.user2.profile.save()
+        AuthUtils.connect_signals()
+        cls.token = Token.objects.create(user=cls.user, access_token='a', character_id=1, character_name='test character 1', character_owner_hash='hash1')
+        cls.corpstat = CorpStat.objects.create(corp=cls.corp, token=cls.token)
+        for c_id in (1, 6, 20):
+            CorpMember.objects.create(corpstats=cls.corpstat, character_id=c_id, character_name=f'test character {c_id}')
+
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        AuthUtils.disconnect_signals()
+
+    def tearDown(self):
+        AuthUtils.connect_signals()
+
+    def test_delta_matches_full_recompute(self):
+        before = self.corpstat.get_cached_overview()['data']
+        self.assertEqual(before['orphan_count'], 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user2.profile.main_character = self.chars[6]
+            self.user2.profile.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            char = EveCharacter.objects.create(character_id=21, character_name='test character 21', corporation_id=2, corporation_name='test', corporation_ticker='TEST')
+            CharacterOwnership.objects.create(character=char, user=self.user, owner_hash='hash21')
+        delta = self.corpstat.get_cached_overview()['data']
+        self.assertEqual(delta['total_mains'], 2)
+        self.assertEqual(delta['orphan_count'], 0)
+        self.assertEqual(delta['authd_members'], 3)
+        cache.clear()
+        local_cache.clear()
+        self.assertEqual(delta, self.corpstat.get_cached_overview()['data'])
+
+    def test_changed_in_another_worker(self):
+        self.corpstat.get_cached_overview()
+        with mock.patch.object(local_cache.overviews, 'delete'):  # the celery worker only clears its own copy
+            with self.captureOnCommitCallbacks(execute=True):
+                CharacterOwnership.objects.filter(character=self.chars[6]).delete()
+        self.assertEqual(self.corpstat.get_cached_overview()['data']['authd_members'], 1)
+        self.assertEqual(CorpStat.objects.filter(pk=self.corpstat.pk).get_cached_overviews()[0]['data']['authd_members'], 1)
+
+    def test_ownership_removed(self):
+        self.corpstat.get_cached_overview()
+        with self.captureOnCommitCallbacks(execute=True):
+            CharacterOwnership.objects.filter(character=self.chars[6]).delete()
+        stats = self.corpstat.get_cached_overview()['data']
+        self.assertEqual(stats['authd_members'], 1)
+        self.assertEqual(stats['total_members'], 3)  # now unregistered
+        self.assertEqual(cache.get(STATS_REVISION_KEY), 1)
+
+    def test_user_outside_tracked_corps(self):
+        self.corpstat.get_cached_overview()
+        user = AuthUtils.create_user('test3')
+        # only the users characters are looked up, no corp is recounted
+        with self.assertNumQueries(1):
+            models.update_user_stats(user.pk)
+        self.assertIsNone(cache.get(STATS_REVISION_KEY))
+
+    @mock.patch('corpstats.signals.update_user_corpstats')
+    def test_changes_queued(self, update_user_corpstats):
+        with self.captureOnCommitCallbacks(execute=True):
+            CharacterOwnership.objects.filter(character=self.chars[6]).delete()
+        update_user_corpstats.delay.assert_called_once_with(self.user2.pk, [2])
+
+    def test_uncached_corp_untouched(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            CharacterOwnership.objects.filter(character=self.chars[6]).delete()
+        self.assertIsNone(cache.get(self.corpstat.build_cache_key()))
+        # the corp page still lists the character, so its etag has to change
+        self.assertEqual(cache.get(STATS_REVISION_KEY), 1)
+
+
+class CorpStatsShardTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.corp = EveCorporationInfo.objects.create(corporation_id=2, corporation_name='test corp', corporation_ticker='TEST', member_count=7)
+        AuthUtils.disconnect_signals()
+        cls.users = []
+        for u, (main_corp, alt_corp) in enumerate(((2, 2), (2, 4), (7, 2), (2, 2))):
+            user = AuthUtils.create_user(f'test{u}')
+            main = EveCharacter.objects.create(character_id=u * 10 + 1, character_name=f'test main {u}', corporation_id=main_corp, corporation_name='test', corporation_ticker='TEST')
+            alt = EveCharacter.objects.create(character_id=u * 10 + 2, character_name=f'test alt {u}', corporation_id=alt_corp, corporation_name='test', corporation_ticker='TEST')
+            CharacterOwnership.objects.create(character=main, user=user, owner_hash=f'main{u}')
+            CharacterOwnership.objects.create(character=alt, user=user, owner_hash=f'alt{u}')
+            user.profile.main_character = main
+            user.profile.save()
+            cls.users.append(user)
+        AuthUtils.connect_signals()
+        cls.token = Token.objects.create(user=cls.users[0], access_token='a', character_id=1, character_name='test main 0', character_owner_hash='main0')
+        cls.corpstat = CorpStat.objects.create(corp=cls.corp, token=cls.token)
+
+    def test_shards_match_serial(self):
+        # the alt of the last main by name comes first, so the mains aren't in main name order
+        EveCharacter.objects.filter(character_id=32).update(character_name='a first alt')
+        registry = get_service_registry()
+        serial = self.corpstat.count_linked_characters(self.corpstat.get_linked_characters(registry), registry)
+        ids = [u.pk for u in self.users]
+        partials = [models._count_shard((self.corpstat.pk, user_range)) for user_range in ((ids[0], ids[0]), (ids[1], ids[2]), (ids[3], ids[3]))]
+        members, mains, orphans, alt_count, services_count = models.merge_counts(partials, registry.services)
+        self.assertEqual([c.character_id for c in members], [c.character_id for c in serial[0]])
+        self.assertEqual([(m, [a.character_id for a in main['alts']]) for m, main in mains.items()],
+                         [(m, [a.character_id for a in main['alts']]) for m, main in serial[1].items()])
+        self.assertEqual([c.character_id for c in orphans], [22])
+        self.assertEqual(alt_count, serial[3])
+        self.assertEqual(services_count, serial[4])
+
+    def test_recache_in_shard_tasks(self):
+        cache.clear()
+        serial = self.corpstat.get_and_cache_stats(only_context=True)['data']
+        cache.clear()
+        with mock.patch.object(app_settings, 'CORPSTATS_STATS_WORKERS', 3):
+            recache_corpstats(self.corpstat)
+        self.assertEqual(json.loads(cache.get(self.corpstat.build_cache_key()))['data'], serial)
+        self.assertFalse(StatsShard.objects.exists())
+
+    def test_recache_waits_for_every_shard(self):
+        cache.clear()
+        with mock.patch('corpstats.tasks.count_corpstats_shard') as queued, \
+                mock.patch.object(app_settings, 'CORPSTATS_STATS_WORKERS', 2):
+            recache_corpstats(self.corpstat)
+        self.assertEqual(queued.delay.call_count, 2)
+        args = [c.args for c in queued.delay.call_args_list]
+        count_corpstats_shard(*args[0])
+        self.assertIsNone(cache.get(self.corpstat.build_cache_key()))
+        count_corpstats_shard(*args[1])
+        self.assertFalse(StatsShard.objects.exists())
+        self.assertEqual(json.loads(cache.get(self.corpstat.build_cache_key()))['data']['total_mains'], 3)
+
+    def test_shard_delivered_twice(self):
+        cache.clear()
+        with mock.patch('corpstats.tasks.count_corpstats_shard') as queued, \
+                mock.patch.object(app_settings, 'CORPSTATS_STATS_WORKERS', 2):
+            recache_corpstats(self.corpstat)
+        args = [c.args for c in queued.delay.call_args_list]
+        count_corpstats_shard(*args[0])
+        count_corpstats_shard(*args[0])
+        self.assertIsNone(cache.get(self.corpstat.build_cache_key()))
+        self.assertEqual(StatsShard.objects.count(), 1)
+
+    def test_corp_removed_while_counted(self):
+        with mock.patch('corpstats.tasks.count_corpstats_shard') as queued, \
+                mock.patch.object(app_settings, 'CORPSTATS_STATS_WORKERS', 2):
+            recache_corpstats(self.corpstat)
+        args = [c.args for c in queued.delay.call_args_list]
+        count_corpstats_shard(*args[0])
+        self.corpstat.delete()
+        count_corpstats_shard(*args[1])
+        self.assertFalse(StatsShard.objects.exists())
+
+    def test_get_stats_never_forks(self):
+        self.assertIsNone(self.corpstat.count_in_shards(4))  # in-memory database
+        with mock.patch.object(app_settings, 'CORPSTATS_STATS_WORKERS', 4), \
+                mock.patch.object(CorpStat, 'count_in_shards') as count_in_shards:
+            stats = self.corpstat.get_stats()
+        count_in_shards.assert_not_called()
+        self.assertEqual(stats[4], 3)  # mains
+
+
+class SyntheticDataTestCase(TestCase):
+    def test_build_and_remove(self):
+        from .management.commands import _synthetic
+        alliance = _synthetic.build_alliance()
+        state = _synthetic.build_states(1)[0]
+        cs = _synthetic.build_corp(0, 20, alliance=alliance, state=state)
+        self.assertTrue(_synthetic.corps_exist())
+        self.assertEqual(cs.members.count(), 20)
+        # 16 registered characters, 4 per user
+        self.assertEqual(User.objects.filter(profile__state=state).count(), 4)
+        self.assertEqual(list(state.member_corporations.all()), [cs.corp])
+        members, mains, orphans, unregistered, total_mains, total_unreg, total_members, auth_percent, alt_ratio, service_percent, tracking, services = cs.get_stats()
+        self.assertEqual(total_mains, 4)
+        self.assertEqual(total_unreg, 4)
+        real = EveCharacter.objects.create(character_id=2112000000, character_name='real character',
+                                           corporation_id=98000001, corporation_name='real corp', corporation_ticker='REAL')
+        _synthetic.remove_corps()
+        self.assertFalse(_synthetic.corps_exist())
+        self.assertTrue(EveCharacter.objects.filter(pk=real.pk).exists())
+        self.assertFalse(EveCharacter.objects.filter(corporation_id=cs.corp.corporation_id).exists())
+        self.assertFalse(CorpStat.objects.exists())
+        self.assertFalse(EveAllianceInfo.objects.exists())
+        self.assertFalse(User.objects.filter(username__startswith=_synthetic.USERNAME_PREFIX).exists())
+
+
+class IndexBenchmarkTestCase(TestCase):
+    def test_needs_debug(self):
+        with self.assertRaises(CommandError):
+            call_command('corpstats_index_benchmark', corps=1, members=1)
+        self.assertFalse(CorpStat.objects.exists())
+
+    def test_id_span(self):
+        with self.assertRaises(CommandError), self.settings(DEBUG=True):
+            call_command('corpstats_index_benchmark', corps=2, members=10000000)
+        self.assertFalse(CorpStat.objects.exists())
+
+
+class PermissionScopeTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = AuthUtils.create_user('test')
+        cls.user.user_permissions.add(Permission.objects.get_by_natural_key('add_corpstat', 'corpstats', 'corpstat'))
+
+    def test_scope(self):
+        scope = get_permission_scope(User.objects.get(pk=self.user.pk))
+        self.assertTrue(scope.add)
+        self.assertTrue(scope.in_menu)
+        self.assertFalse(scope.can_view)
+
+    def test_scope_once_per_request(self):
+        user = User.objects.get(pk=self.user.pk)
+        get_permission_scope(user)
+        with self.assertNumQueries(0):
+            self.assertTrue(get_permission_scope(user).in_menu)
+            self.assertFalse(access_corpstats_test(user))
+
+    def test_scope_revoked(self):
+        self.assertTrue(get_permission_scope(User.objects.get(pk=self.user.pk)).add)
+        self.user.user_permissions.clear()
+        # the next request sees it straight away
+        self.assertFalse(get_permission_scope(User.objects.get(pk=self.user.pk)).add)
+
+    def test_scope_superuser(self):
+        user = User.objects.get(pk=self.user.pk)
+        self.assertFalse(get_permission_scope(user).view_all)
+        user.is_superuser = True
+        self.assertTrue(get_permission_scope(user).view_all)
+
+    def test_menu_hidden(self):
+        request = RequestFactory().get('/')
+        request.user = AuthUtils.create_user('no perms')
+        self.assertEqual(CorpStatsMenu().render(request), '')
+
+
+class LocalCacheTestCase(TestCase):
+    def test_lru(self):
+        lru = local_cache.LocalCache(2, 60)
+        lru.set(1, 'a')
+        lru.set(2, 'b')
+        lru.get(1)
+        lru.set(3, 'c')  # evicts 2, 1 was used more recently
+        self.assertIsNone(lru.get(2))
+        self.assertEqual(lru.get(1), 'a')
+        self.assertEqual(lru.stats()['hits'], 2)
+        self.assertEqual(lru.stats()['misses'], 1)
+
+    def test_version_and_ttl(self):
+        lru = local_cache.LocalCache(2, 60)
+        lru.set(1, 'a', version=1)
+        self.assertIsNone(lru.get(1, version=2))
+        with mock.patch('corpstats.local_cache.time.monotonic', return_value=local_cache.time.monotonic() + 61):
+            self.assertIsNone(lru.get(1, version=1))
+
+    def test_disabled(self):
+        lru = local_cache.LocalCache(0, 60)
+        lru.set(1, 'a')
+        self.assertIsNone(lru.get(1))
+
+    def test_hit_rates_view(self):
+        user = AuthUtils.create_user('test')
+        AuthUtils.add_main_character(user, 'test character', '1', corp_id='2', corp_name='test corp', corp_ticker='TEST')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(reverse('corpstat:cache_stats')).status_code, 302)
+        user.user_permissions.add(Permission.objects.get_by_natural_key('view_all_corpstats', 'corpstats', 'corpstat'))
+        response = self.client.get(reverse('corpstat:cache_stats'))
+        self.assertEqual(set(response.json()), {'overviews', 'visibility'})
+
+
 class CorpStatsPropertiesTestCase(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -203,6 +1100,39 @@ class CorpStatsPropertiesTestCase(TestCase):
         self.assertEqual(self.corpstat.alliance_logo(size=128),  self.alliance.logo_url_128)
 
 
+class ServiceRegistryTestCase(TestCase):
+    def setUp(self):
+        models._service_registry = None
+
+    @staticmethod
+    def _service(name):
+        svc = mock.Mock()
+        svc.name = name
+        return svc
+
+    @mock.patch('corpstats.models.hooks.get_hooks')
+    @mock.patch('corpstats.models.ServicesHook.get_services')
+    def test_resolved_once(self, get_services, get_hooks):
+        get_hooks.return_value = [mock.sentinel.discord_hook, mock.sentinel.unknown_hook]
+        get_services.return_value = [self._service('discord'), self._service('unknown')]
+        registry = get_service_registry()
+        self.assertEqual(registry.services, ('discord',))
+        self.assertEqual(registry.relations, {'discord': 'discord'})
+        get_service_registry()
+        self.assertEqual(get_services.call_count, 1)
+
+    @mock.patch('corpstats.models.hooks.get_hooks')
+    @mock.patch('corpstats.models.ServicesHook.get_services')
+    def test_hooks_changed(self, get_services, get_hooks):
+        get_hooks.return_value = [mock.sentinel.discord_hook]
+        get_services.return_value = [self._service('discord')]
+        get_service_registry()
+        get_hooks.return_value = [mock.sentinel.discord_hook, mock.sentinel.mumble_hook]
+        get_services.return_value = [self._service('discord'), self._service('mumble')]
+        self.assertEqual(get_service_registry().services, ('discord', 'mumble'))
+        self.assertEqual(get_services.call_count, 2)
+
+
 class CorpMemberTestCase(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -216,3 +1146,19 @@ class CorpMemberTestCase(TestCase):
 
     def test_portrait_url(self):
         self.assertEquals(self.member.portrait_url(size=32), self.member.portrait_url_32)
+        self.assertEqual(self.member.portrait_url(size=64), self.member.portrait_url_64)
+        self.assertEqual(self.member.portrait_url(size=256), self.member.portrait_url_256)
+        with self.assertRaises(AttributeError):
+            self.member.not_a_field
+
+    def test_portrait_url_filter(self):
+        from .templatetags.corp_tags import member_portrait_url
+        models._character_portrait_url.cache_clear()
+        self.assertEqual(member_portrait_url(2, 64), self.member.portrait_url(64))
+        self.assertEqual(member_portrait_url('2', '64'), self.member.portrait_url(64))
+        self.assertEqual(models.character_portrait_url(2, size=64), models.character_portrait_url(2, 64))
+        self.assertEqual(models._character_portrait_url.cache_info().hits, 5)
+        self.assertEqual(models._character_portrait_url.cache_info().currsize, 1)
+        self.assertEqual(member_portrait_url(None, 32), '')
+        self.assertEqual(member_portrait_url('not an id', 32), '')
+        self.assertEqual(member_portrait_url(2, 'big'), '')
@@ -10,6 +10,12 @@ urlpatterns = [
     re_path(r'^overview/$', views.overview_view, name='view_all'),
     re_path(r'^(?P<corp_id>(\d)*)/$', views.corpstat_view, name='view_corp'),
     re_path(r'^(?P<corp_id>(\d)+)/update/$', views.corpstats_update, name='update'),
+    re_path(r'^(?P<corp_id>(\d)+)/update/status/$', views.corpstats_update_status, name='update_status'),
     re_path(r'^(?P<corp_id>(\d)+)/export/$', views.export_corpstats, name='export'), # has no permissions
+    re_path(r'^(?P<corp_id>(\d)+)/alts/(?P<main_id>(\d)+)/$', views.corpstats_alts, name='alts'),
     re_path(r'^search/$', views.corpstats_search, name='search'),
+    re_path(r'^cache/$', views.local_cache_stats, name='cache_stats'),
+    re_path(r'^api/members/$', views.api_members, name='api_members'),
+    re_path(r'^api/mains/$', views.api_mains, name='api_mains'),
+    re_path(r'^api/unregistered/$', views.api_unregistered, name='api_unregistered'),
     ]
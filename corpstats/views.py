@@ -3,50 +3,82 @@ import os
 from bravado.exception import HTTPError
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required, permission_required, user_passes_test
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
 from django.db import IntegrityError
-from django.db.models import Count
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, F, OuterRef, Q, Subquery
 from django.shortcuts import render, redirect, get_object_or_404
 from django.utils.translation import gettext_lazy as _
+from django.views.decorators.http import condition
 from esi.decorators import token_required
+from allianceauth.eveonline.evelinks import eveimageserver, zkillboard
 from allianceauth.eveonline.models import EveCharacter, EveCorporationInfo
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
 import csv
+import hashlib
+import json
 import re
-from itertools import chain
+from itertools import chain, groupby
+from operator import itemgetter
 from allianceauth.services.hooks import ServicesHook
 
-from .models import CorpStat, CorpMember
+from . import app_settings, local_cache
+from .models import CorpStat, CorpMember, character_portrait_url, get_stats_revision
+from .permissions import get_permission_scope
+from .tasks import get_refresh_status, queue_corpstats_refresh
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 def access_corpstats_test(user):
-    return user.has_perm('corpstats.view_corp_corpstats') \
-           or user.has_perm('corpstats.view_alliance_corpstats') \
-           or user.has_perm('corpstats.view_state_corpstats') \
-           or user.has_perm('corpstats.view_all_corpstats')
+    return get_permission_scope(user).can_view
 
 
 def corpstats_visible_to_user(view):
-    def check_corpstats(request, corp_id=None):
+    def check_corpstats(request, corp_id=None, **kwargs):
         if corp_id:
             corp = get_object_or_404(EveCorporationInfo, corporation_id=corp_id)
             corpstats = get_object_or_404(CorpStat, corp=corp)
 
-            # get available models
-            available = CorpStat.objects.visible_to(request.user)
-
             # ensure we can see the requested model
-            if corpstats and corpstats not in available:
+            if not corpstats.visible_to(request.user):
                 raise PermissionDenied('You do not have permission to view the selected corporation statistics module.')
         else:
             corpstats = None
-        return view(request, corpstats, corp_id=corp_id)
+        return view(request, corpstats, corp_id=corp_id, **kwargs)
     return check_corpstats
 
 
+def _visible_scope(request):
+    """
+    pk and last update of every CorpStat visible to the user, looked up once per request
+    """
+    if not hasattr(request, '_corpstats_scope'):
+        request._corpstats_scope = list(CorpStat.objects.visible_to(request.user).order_by('pk')
+                                        .values_list('pk', 'last_update'))
+    return request._corpstats_scope
+
+
+def _scope_etag(request, corp_id=None, **_):
+    # pages carry the users messages, those have to be rendered rather than answered with a 304
+    if messages.get_messages(request):
+        return None
+    scope = ','.join(f"{pk}:{last_update.timestamp()}" for pk, last_update in _visible_scope(request))
+    # stats also change between updates when users change their characters
+    revision = get_stats_revision()
+    return hashlib.md5(f"{request.user.pk}/{corp_id}/{revision}/{scope}".encode()).hexdigest()
+
+
+def _corpstats_etag(request, corpstats, **_):
+    return hashlib.md5(f"{corpstats.pk}:{corpstats.last_update.timestamp()}".encode()).hexdigest()
+
+
+def _corpstats_last_modified(request, corpstats, **_):
+    return corpstats.last_update
+
+
 @login_required
 @user_passes_test(access_corpstats_test)
 @permission_required('corpstats.add_corpstat')
@@ -79,6 +111,7 @@ def corpstats_add(request, token):
 
 @login_required
 @user_passes_test(access_corpstats_test)
+@condition(etag_func=_scope_etag)
 def corpstat_view(request, corp_id=None):
 
     corpstats = None
@@ -92,7 +125,7 @@ def corpstat_view(request, corp_id=None):
     available = CorpStat.objects.visible_to(request.user).order_by('corp__corporation_name').select_related('corp')
 
     # ensure we can see the requested model
-    if corpstats and corpstats not in available:
+    if corpstats and not available.filter(pk=corpstats.pk).exists():
         raise PermissionDenied('You do not have permission to view the selected corporation statistics module.')
 
     # get default model if none requested
@@ -126,7 +159,8 @@ def corpstat_view(request, corp_id=None):
             'alt_ratio': alt_ratio,
             'unregistered': unregistered,
             'tracking': tracking,
-            "services": services
+            "services": services,
+            'lazy_mains': app_settings.CORPSTATS_LAZY_MAINS
         })
 
     return render(request, 'corpstat/corpstats.html', context=context)  # render to template
@@ -134,15 +168,53 @@ def corpstat_view(request, corp_id=None):
 @login_required
 @user_passes_test(access_corpstats_test)
 @corpstats_visible_to_user
-def corpstats_update(request, corpstats, **_):
-    try:
-        corpstats.update()
-    except HTTPError as e:
-        messages.error(request, str(e))
-    if corpstats.pk:
-        return redirect('corpstat:view_corp', corp_id=corpstats.corp.corporation_id)
+def corpstats_update(request, corpstats, **kwargs):
+    if queue_corpstats_refresh(corpstats.pk):
+        messages.info(request, _('Update queued, the page will refresh once it is done.'))
     else:
-        return redirect('corpstat:view')
+        messages.info(request, _('An update is already in progress.'))
+    return redirect('corpstat:view_corp', corp_id=corpstats.corp.corporation_id)
+
+
+@login_required
+@user_passes_test(access_corpstats_test)
+@corpstats_visible_to_user
+def corpstats_update_status(request, corpstats, **_):
+    """
+    Status of the last manual update, polled by the corp page
+    """
+    status = get_refresh_status(corpstats.pk) or {'status': None, 'error': None, 'date': None}
+    return JsonResponse(dict(status, last_update=corpstats.last_update))
+
+
+@login_required
+@user_passes_test(access_corpstats_test)
+@corpstats_visible_to_user
+def corpstats_alts(request, corpstats, main_id, **_):
+    """
+    Alts of a main in the corp, for expanding a main on the lazy mains tab
+    """
+    # alts change with the corps updates and when users change their characters, like the corp page
+    cache_key = f"{corpstats.build_cache_key()}_ALTS_{main_id}_{int(corpstats.last_update.timestamp() * 1000000)}_" \
+                f"{get_stats_revision()}"
+    alts = cache.get(cache_key)
+    if alts is None:
+        main = EveCharacter.objects.filter(character_id=main_id, corporation_id=corpstats.corp.corporation_id,
+                                           userprofile__isnull=False).first()
+        if main is None:
+            raise Http404('Main character not found in the selected corporation.')
+        alts = [dict(alt,
+                     portrait_url=character_portrait_url(alt['character_id'], size=32),
+                     corporation_logo_url=eveimageserver.corporation_logo_url(alt['corporation_id'], size=32),
+                     alliance_logo_url=eveimageserver.alliance_logo_url(alt['alliance_id'], size=32)
+                     if alt['alliance_id'] else None,
+                     killboard_url=zkillboard.character_url(alt['character_id']))
+                for alt in EveCharacter.objects.filter(character_ownership__user__profile__main_character=main)
+                .order_by('character_name')
+                .values('character_id', 'character_name', 'corporation_id', 'corporation_name',
+                        'alliance_id', 'alliance_name')]
+        cache.set(cache_key, alts, app_settings.CORPSTATS_ALTS_CACHE_TIME)
+    return JsonResponse({'alts': alts})
 
 
 @login_required
@@ -151,13 +223,11 @@ def corpstats_search(request):
     results = []
     search_string = request.GET.get('search_string', None)
     if search_string:
-        has_similar = CorpStat.objects.filter(members__character_name__icontains=search_string).visible_to(
-            request.user).distinct()
-        for corpstats in has_similar:
-            similar = corpstats.members.filter(character_name__icontains=search_string)
-            for s in similar:
-                results.append((corpstats, s))
-        results = sorted(results, key=lambda x: x[1].character_name)
+        similar = CorpMember.objects.filter(character_name__icontains=search_string,
+                                            corpstats__in=CorpStat.objects.visible_to(request.user)) \
+            .select_related('corpstats__corp').order_by('character_name')
+        for s in similar:
+            results.append((s.corpstats, s))
         available = CorpStat.objects.visible_to(request.user).order_by('corp__corporation_name').select_related('corp')
         context = {
             'available': available, # list what stats are visible to user
@@ -170,13 +240,12 @@ def corpstats_search(request):
 
 @login_required
 @user_passes_test(access_corpstats_test)
+@condition(etag_func=_scope_etag)
 def overview_view(request):
     # get available models
-    all_corps = CorpStat.objects.visible_to(request.user)
+    all_corps = CorpStat.objects.visible_to(request.user).select_related('corp')
 
-    stats = []
-    for corp in all_corps:
-        stats.append(corp.get_cached_overview())
+    stats = all_corps.get_cached_overviews()
 
     context = {
         'available': all_corps,
@@ -189,6 +258,7 @@ def overview_view(request):
 @login_required
 @user_passes_test(access_corpstats_test)
 @corpstats_visible_to_user
+@condition(etag_func=_corpstats_etag, last_modified_func=_corpstats_last_modified)
 def export_corpstats(request, corpstats, **_):
     if not corpstats.members.all().exists():
         # there are no members, say there's no data
@@ -213,3 +283,131 @@ def export_corpstats(request, corpstats, **_):
         writer.writerow(row)
 
     return response
+
+
+@login_required
+@permission_required('corpstats.view_all_corpstats')
+def local_cache_stats(request):
+    """
+    Hit rates of the in-process caches of the worker serving the request
+    """
+    return JsonResponse(local_cache.get_hit_rates())
+
+
+API_PAGE_SIZE = 1000
+API_MAX_PAGE_SIZE = 10000
+
+
+def _member_cursor(after):
+    # members are rebuilt on every update, so they page on the corp and character rather than their pk
+    corpstats_id, character_id = after.split(':')
+    return int(corpstats_id), int(character_id)
+
+
+def _api_page(request, parse_cursor=int, start=0):
+    """
+    keyset pagination arguments, `after` is the cursor of the last row the client has seen
+    """
+    after = parse_cursor(request.GET['after']) if 'after' in request.GET else start
+    limit = int(request.GET.get('limit', API_PAGE_SIZE))
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return after, min(limit, API_MAX_PAGE_SIZE)
+
+
+def _api_response(request, rows, limit):
+    """
+    Stream rows to the client as NDJSON, or as a JSON document with the `next` cursor if `format=json`
+    """
+    if request.GET.get('format') == 'json':
+        def content():
+            yield '{"results": ['
+            count = 0
+            cursor = None
+            for row in rows:
+                yield (',' if count else '') + json.dumps(row, cls=DjangoJSONEncoder)
+                count += 1
+                cursor = row['cursor']
+            yield '], "next": %s}' % json.dumps(cursor if count == limit else None)
+        return StreamingHttpResponse(content(), content_type='application/json')
+
+    return StreamingHttpResponse((json.dumps(row, cls=DjangoJSONEncoder) + '\n' for row in rows),
+                                 content_type='application/x-ndjson')
+
+
+def _api_members(request, unregistered=False):
+    try:
+        (after_corpstats, after_character), limit = _api_page(request, _member_cursor, (0, 0))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    main = EveCharacter.objects.filter(character_id=OuterRef('character_id'),
+                                       character_ownership__user__profile__main_character__isnull=False) \
+        .values('character_ownership__user__profile__main_character')
+    members = CorpMember.objects.filter(Q(corpstats_id__gt=after_corpstats) |
+                                        Q(corpstats_id=after_corpstats, character_id__gt=after_character),
+                                        corpstats__in=CorpStat.objects.visible_to(request.user)) \
+        .annotate(main_pk=Subquery(main[:1]))
+    if unregistered:
+        members = members.filter(main_pk__isnull=True)
+    else:
+        members = members.annotate(
+            main_character_id=Subquery(EveCharacter.objects.filter(pk=OuterRef('main_pk')).values('character_id')[:1]),
+            main_character_name=Subquery(EveCharacter.objects.filter(pk=OuterRef('main_pk')).values('character_name')[:1]))
+
+    fields = ['character_id', 'character_name', 'ship_type_id', 'ship_type_name', 'location_id', 'location_name',
+              'start_date', 'logon_date', 'logoff_date']
+    if not unregistered:
+        fields += ['main_character_id', 'main_character_name']
+    rows = members.order_by('corpstats_id', 'character_id').values(
+        *fields, 'corpstats_id', corporation_id=F('corpstats__corp__corporation_id'),
+        corporation_name=F('corpstats__corp__corporation_name'))[:limit]
+
+    def with_cursor(rows):
+        for row in rows:
+            row['cursor'] = f"{row.pop('corpstats_id')}:{row['character_id']}"
+            yield row
+    return _api_response(request, with_cursor(rows.iterator()), limit)
+
+
+@login_required
+@user_passes_test(access_corpstats_test)
+def api_members(request):
+    return _api_members(request)
+
+
+@login_required
+@user_passes_test(access_corpstats_test)
+def api_unregistered(request):
+    return _api_members(request, unregistered=True)
+
+
+@login_required
+@user_passes_test(access_corpstats_test)
+def api_mains(request):
+    try:
+        after, limit = _api_page(request)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    character_fields = ['character_id', 'character_name', 'corporation_id', 'corporation_name',
+                        'alliance_id', 'alliance_name']
+    corp_ids = CorpStat.objects.visible_to(request.user).values('corp__corporation_id')
+    mains = list(EveCharacter.objects.filter(userprofile__isnull=False, corporation_id__in=corp_ids,
+                                             character_id__gt=after)
+                 .order_by('character_id').values(*character_fields)[:limit])
+
+    def rows():
+        alts = EveCharacter.objects.filter(
+            character_ownership__user__profile__main_character__character_id__in=[m['character_id'] for m in mains]) \
+            .order_by('character_ownership__user__profile__main_character__character_id', 'character_name') \
+            .values(*character_fields, main_id=F('character_ownership__user__profile__main_character__character_id'))
+        alts = {main_id: list(chars) for main_id, chars in groupby(alts.iterator(), key=itemgetter('main_id'))}
+        for main in mains:
+            main['cursor'] = main['character_id']
+            main['alts'] = alts.get(main['character_id'], [])
+            for alt in main['alts']:
+                del alt['main_id']
+            yield main
+
+    return _api_response(request, rows(), limit)
@@ -14,6 +14,14 @@ INSTALLED_APPS += [
 
 ROOT_URLCONF = 'tests.urls'
 
+SITE_URL = 'https://example.com'
+
+# templates are rendered in the tests without a collectstatic manifest
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
 NOSE_ARGS = [
     #'--with-coverage',
     #'--cover-package=',
@@ -1,4 +1,4 @@
-from django.conf.urls import url
+from django.urls import re_path
 
 import allianceauth.urls
 from . import views
@@ -7,8 +7,8 @@ urlpatterns = allianceauth.urls.urlpatterns
 
 urlpatterns += [
     # Navhelper test urls
-    url(r'^main-page/$', views.page, name='p1'),
-    url(r'^main-page/sub-section/$', views.page, name='p1-s1'),
-    url(r'^second-page/$', views.page, name='p1'),
+    re_path(r'^main-page/$', views.page, name='p1'),
+    re_path(r'^main-page/sub-section/$', views.page, name='p1-s1'),
+    re_path(r'^second-page/$', views.page, name='p1'),
 ]
 